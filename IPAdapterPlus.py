@@ -1,9 +1,16 @@
 import torch
 import contextlib
+import copy
+import math
 import os
+import psutil
+import tempfile
+import weakref
+from collections import OrderedDict
 
 import comfy.utils
 import comfy.model_management
+import comfy.model_patcher
 from comfy.clip_vision import clip_preprocess
 from comfy.ldm.modules.attention import optimized_attention
 import folder_paths
@@ -12,17 +19,34 @@ from torch import nn
 from PIL import Image
 import torch.nn.functional as F
 import torchvision.transforms as TT
+import torchvision.transforms.functional as TF
 
 from .resampler import Resampler
+from .embeds_cache import EmbedsCache, tensor_hash
+from .file_index import get_file_index
+from .profiler import AttentionProfiler, no_section
+from safetensors import safe_open
+from safetensors.torch import save_file
 
 MODELS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
 
+# size in MB of the in-memory cache of loaded IPAdapter models, 0 disables it
+MODEL_CACHE_SIZE = int(os.environ.get("IPADAPTER_MODEL_CACHE_MB", 2048))
+
+# optional disk cache of the clip vision embeddings, disabled if the directory is not set
+EMBEDS_CACHE_DIR = os.environ.get("IPADAPTER_EMBEDS_CACHE_DIR")
+EMBEDS_CACHE_SIZE = int(os.environ.get("IPADAPTER_EMBEDS_CACHE_MB", 1024))
+embeds_cache = EmbedsCache(EMBEDS_CACHE_DIR, EMBEDS_CACHE_SIZE * 1024 * 1024) if EMBEDS_CACHE_DIR else None
+
+# embeds saved by older versions are pickled tensors
+EMBEDS_EXTENSIONS = (".ipadpt.safetensors", ".ipadpt")
+
 # attention_channels
 SD_V12_CHANNELS = [320] * 4 + [640] * 4 + [1280] * 4 + [1280] * 6 + [640] * 6 + [320] * 6 + [1280] * 2
 SD_XL_CHANNELS = [640] * 8 + [1280] * 40 + [1280] * 60 + [640] * 12 + [1280] * 20
 
 def get_filename_list(path):
-    return [f for f in os.listdir(path) if f.endswith('.bin') or f.endswith('.safetensors')]
+    return get_file_index(path, ('.bin', '.safetensors'), recursive=False).list()
 def pad_to_square(tensor):
     tensor = tensor.squeeze(0).permute(2, 0, 1)
     _, h, w = tensor.shape
@@ -69,16 +93,161 @@ class ImageProjModel(nn.Module):
         clip_extra_context_tokens = self.norm(clip_extra_context_tokens)
         return clip_extra_context_tokens
 
+# storage types of the quantized IPAdapter weights
+QUANTIZE_DTYPES = {"int8": torch.int8}
+if hasattr(torch, "float8_e4m3fn"):
+    QUANTIZE_DTYPES["fp8_e4m3fn"] = torch.float8_e4m3fn
+
+# rows of a quantized weight that are dequantized at a time
+DEQUANTIZE_CHUNK_ROWS = 16384
+
+def quantize_weight(weight, mode):
+    # weight only quantization with one scale per output channel, a few rows at a time
+    dtype = QUANTIZE_DTYPES[mode]
+    max_value = 127 if dtype == torch.int8 else torch.finfo(dtype).max
+    quantized = torch.empty(weight.shape, dtype=dtype, device=weight.device)
+    scale = torch.empty((weight.shape[0], 1), dtype=torch.float32, device=weight.device)
+    for w, q, s in zip(weight.split(DEQUANTIZE_CHUNK_ROWS), quantized.split(DEQUANTIZE_CHUNK_ROWS), scale.split(DEQUANTIZE_CHUNK_ROWS)):
+        w = w.float()
+        s.copy_(w.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / max_value)
+        w = w / s
+        if dtype == torch.int8:
+            w = w.round_().clamp_(-127, 127)
+        q.copy_(w)
+    return quantized, scale
+
+def dequantized_linear(x, weight, scale=None):
+    if scale is None:
+        return F.linear(x, weight)
+
+    # the weight is dequantized a few rows at a time so that a full precision copy never exists
+    if weight.shape[0] <= DEQUANTIZE_CHUNK_ROWS:
+        return F.linear(x, weight.to(x.dtype) * scale.to(x.dtype))
+    return torch.cat([F.linear(x, w.to(x.dtype) * s.to(x.dtype)) for w, s in zip(weight.split(DEQUANTIZE_CHUNK_ROWS), scale.split(DEQUANTIZE_CHUNK_ROWS))], dim=-1)
+
+class QuantizedLinear(nn.Module):
+    def __init__(self, linear, mode):
+        super().__init__()
+        weight, scale = quantize_weight(linear.weight.data, mode)
+        self.register_buffer("weight", weight)
+        self.register_buffer("scale", scale)
+        self.bias = linear.bias
+
+    def forward(self, x):
+        out = dequantized_linear(x, self.weight, self.scale)
+        return out + self.bias.to(out.dtype) if self.bias is not None else out
+
+def quantize_linears(module, mode):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, QuantizedLinear(child, mode))
+        else:
+            quantize_linears(child, mode)
+
 class To_KV(nn.Module):
+    # all the to_k_ip/to_v_ip weights packed in a single [sum(channels), cross_attention_dim] buffer.
+    # Every layer projects the same embeds, so a run of consecutive layers is a single matmul
+    # against a slice of the buffer instead of one nn.Linear per layer
     def __init__(self, cross_attention_dim):
         super().__init__()
 
-        channels = SD_XL_CHANNELS if cross_attention_dim == 2048 else SD_V12_CHANNELS
-        self.to_kvs = nn.ModuleList([nn.Linear(cross_attention_dim, channel, bias=False) for channel in channels])
-        
+        self.channels = SD_XL_CHANNELS if cross_attention_dim == 2048 else SD_V12_CHANNELS
+        self.offsets = [0]
+        for channel in self.channels:
+            self.offsets.append(self.offsets[-1] + channel)
+        # the weights are only allocated when the state dict is loaded
+        self.register_buffer("weight", torch.empty(self.offsets[-1], cross_attention_dim, device="meta"))
+        self.register_buffer("scale", None)
+
     def load_state_dict(self, state_dict):
-        for i, key in enumerate(state_dict.keys()):
-            self.to_kvs[i].weight.data = state_dict[key]
+        weights = list(state_dict.values())
+        if [weight.shape[0] for weight in weights] != self.channels:
+            raise Exception("invalid IPAdapter model, the ip_adapter layers don't match the model type")
+        self.weight = torch.cat(weights, dim=0)
+
+    def quantize(self, mode):
+        weight, scale = quantize_weight(self.weight, mode)
+        self.weight = weight
+        self.scale = scale
+
+    def forward(self, x, numbers=None):
+        # {number: (k, v)} for the layers in numbers (all of them by default). The K/V of consecutive
+        # layers are views of the output of the same matmul
+        numbers = sorted(range(len(self.channels) // 2) if numbers is None else numbers)
+        runs = []
+        for number in numbers:
+            if runs and runs[-1][-1] == number - 1:
+                runs[-1].append(number)
+            else:
+                runs.append([number])
+
+        kvs = {}
+        for run in runs:
+            start, end = self.offsets[run[0]*2], self.offsets[run[-1]*2 + 2]
+            scale = self.scale[start:end] if self.scale is not None else None
+            out = dequantized_linear(x, self.weight[start:end], scale)
+            out = out.split(self.channels[run[0]*2:run[-1]*2 + 2], dim=-1)
+            for i, number in enumerate(run):
+                kvs[number] = (out[i*2], out[i*2 + 1])
+        return kvs
+
+# storage type of the cached K/V, "auto" keeps the type of the model
+KV_CACHE_DTYPES = {"auto": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+class KVCache:
+    # the image embeds don't change during sampling, so the K/V projections of every
+    # patched layer are computed once when the IPAdapter is applied instead of at each step
+    def __init__(self, ipadapter, cond, uncond, dtype=None, numbers=None):
+        self.dtype = dtype if dtype is not None else cond.dtype
+        with torch.inference_mode():
+            kvs_cond = ipadapter.ip_layers(cond, numbers)
+            kvs_uncond = ipadapter.ip_layers(uncond, numbers)
+        self.kvs = {number: (k_cond.to(self.dtype), kvs_uncond[number][0].to(self.dtype), v_cond.to(self.dtype), kvs_uncond[number][1].to(self.dtype))
+                    for number, (k_cond, v_cond) in kvs_cond.items()}
+
+    def get(self, number, dtype, device=None):
+        return tuple(kv.to(device, dtype) for kv in self.kvs[number])
+
+class MaskPyramid:
+    # the attention mask resized for every attention level. Each size is interpolated only once
+    # and then shared by all the layers and sampling steps
+    def __init__(self, mask):
+        # a single mask is applied to the whole batch, a batch of masks is applied frame by frame
+        self.mask = mask.reshape(-1, mask.shape[-2], mask.shape[-1])
+        self.levels = {}
+        self.chunks = {}
+
+    def get(self, lh, lw, qs, batch_prompt, cond_or_uncond, dtype):
+        key = (lh, lw, qs, batch_prompt, len(cond_or_uncond), dtype)
+        if key not in self.levels:
+            for rate in [1, 2, 4, 8]:
+                mask_h = -(-lh//rate) # fancy ceil
+                mask_w = -(-lw//rate)
+
+                if mask_h*mask_w == qs:
+                    break
+
+            mask = F.interpolate(self.mask.unsqueeze(1), size=(mask_h, mask_w), mode="bilinear")
+            mask = mask.view(mask.shape[0], -1, 1).to(dtype)
+
+            # the mask is broadcast over the channels (and over the batch when there's only one)
+            if mask.shape[0] > 1:
+                frames = torch.arange(batch_prompt, device=mask.device) % mask.shape[0]
+                mask = mask[frames].repeat(len(cond_or_uncond), 1, 1)
+
+            self.levels[key] = mask
+
+        return self.levels[key]
+
+    def active_chunks(self, lh, lw, qs, batch_prompt, cond_or_uncond, dtype, chunk_size):
+        # for each slice of chunk_size query tokens, whether the mask has any non zero value in it.
+        # Computed once per mask level with a single sync
+        key = (lh, lw, qs, batch_prompt, len(cond_or_uncond), dtype, chunk_size)
+        if key not in self.chunks:
+            mask = self.get(lh, lw, qs, batch_prompt, cond_or_uncond, dtype)
+            active = (mask.squeeze(-1) != 0).any(dim=0)
+            self.chunks[key] = torch.stack([chunk.any() for chunk in active.split(chunk_size)]).tolist()
+        return self.chunks[key]
 
 def set_model_patch_replace(model, patch_kwargs, key):
     to = model.model_options["transformer_options"]
@@ -92,23 +261,43 @@ def set_model_patch_replace(model, patch_kwargs, key):
     else:
         to["patches_replace"]["attn2"][key].set_new_condition(**patch_kwargs)
 
-def image_add_noise(image, noise):
-    image = image.permute([0,3,1,2])
-    torch.manual_seed(0) # use a fixed random for reproducible results
-    transforms = TT.Compose([
-        TT.CenterCrop(min(image.shape[2], image.shape[3])),
-        TT.Resize((224, 224), interpolation=TT.InterpolationMode.BICUBIC, antialias=True),
-        TT.ElasticTransform(alpha=75.0, sigma=noise*3.5), # shuffle the image
-        TT.RandomVerticalFlip(p=1.0), # flip the image to change the geometry even more
-        TT.RandomHorizontalFlip(p=1.0),
-    ])
-    image = transforms(image.cpu())
+def image_add_noise(image, noise, device=None):
+    # a local generator with a fixed seed gives reproducible results without touching the global RNG.
+    # The displacement and the noise are drawn once and shared by all the images, so each negative
+    # image only depends on its own source image
+    generator = torch.Generator(device=device).manual_seed(0)
+    image = image.permute([0,3,1,2]).to(device)
+    image = TF.center_crop(image, min(image.shape[2], image.shape[3]))
+    image = TF.resize(image, [224, 224], interpolation=TT.InterpolationMode.BICUBIC, antialias=True)
+
+    # shuffle the image (same as TT.ElasticTransform(alpha=75.0, sigma=noise*3.5))
+    sigma = noise*3.5
+    kernel_size = int(8 * sigma + 1) // 2 * 2 + 1
+    displacement = torch.rand([2, 1, 224, 224], generator=generator, device=device) * 2 - 1
+    displacement = TF.gaussian_blur(displacement, [kernel_size, kernel_size], [sigma, sigma])
+    displacement = displacement * 75.0 / 224
+    image = TF.elastic_transform(image, displacement.permute([1,2,3,0]), TT.InterpolationMode.BILINEAR, [0.0])
+
+    image = image.flip(2, 3) # flip the image to change the geometry even more
     image = image.permute([0,2,3,1])
-    image = image + ((0.25*(1-noise)+0.05) * torch.randn_like(image) )   # add further random noise
+    image = image + ((0.25*(1-noise)+0.05) * torch.randn([1, 224, 224, 3], generator=generator, device=device))   # add further random noise
     return image
 
+# hidden states of an empty image for each clip vision model and dtype
+zeroed_hidden_states_cache = weakref.WeakKeyDictionary()
+
 def zeroed_hidden_states(clip_vision, batch_size):
-    image = torch.zeros([batch_size, 224, 224, 3])
+    # the result only depends on the clip vision model, so a single image is encoded once
+    # and the same hidden states are broadcast to the batch size
+    cache = zeroed_hidden_states_cache.setdefault(clip_vision, {})
+    if clip_vision.dtype not in cache:
+        cache[clip_vision.dtype] = encode_zeroed_hidden_states(clip_vision)
+
+    outputs = cache[clip_vision.dtype]
+    return outputs.expand(batch_size, -1, -1) if outputs is not None else None
+
+def encode_zeroed_hidden_states(clip_vision):
+    image = torch.zeros([1, 224, 224, 3])
     comfy.model_management.load_model_gpu(clip_vision.patcher)
     pixel_values = clip_preprocess(image.to(clip_vision.load_device))
 
@@ -125,21 +314,137 @@ def zeroed_hidden_states(clip_vision, batch_size):
 
     return outputs
 
-def min_(tensor_list):
-    # return the element-wise min of the tensor list.
-    x = torch.stack(tensor_list)
-    mn = x.min(axis=0)[0]
-    return torch.clamp(mn, min=0)
-    
-def max_(tensor_list):
-    # return the element-wise max of the tensor list.
-    x = torch.stack(tensor_list)
-    mx = x.max(axis=0)[0]
-    return torch.clamp(mx, max=1)
+def encode_image(clip_vision, image, is_plus, hashes=None):
+    # hashes: the content hashes of the images when they are already known (see unique_images)
+    kind = "penultimate_hidden_states" if is_plus else "image_embeds"
+
+    if embeds_cache is None:
+        return getattr(clip_vision.encode_image(image), kind)
+
+    # only the images that are not in the cache are encoded, all in one batch
+    keys = embeds_cache.keys(clip_vision.model, image, kind, hashes)
+    embeds = embeds_cache.get(keys)
+    missing = [i for i, embed in enumerate(embeds) if embed is None]
+
+    if missing:
+        encoded = getattr(clip_vision.encode_image(image[missing]), kind)
+        for i, embed in zip(missing, encoded):
+            embeds_cache.put(keys[i], embed)
+            embeds[i] = embed.cpu()
+
+    return torch.stack(embeds)
+
+def unique_images(image):
+    # the index of the first copy of each distinct image of the batch, for every image the
+    # position of its copy in that list and the hashes of the unique images. Duplicates are found
+    # by hashing the content of the images, the hashes are reused by the embeds cache
+    first = {}
+    unique = []
+    inverse = []
+    hashes = []
+    for i, img in enumerate(image):
+        key = tensor_hash(img)
+        if key not in first:
+            first[key] = len(unique)
+            unique.append(i)
+            hashes.append(key)
+        inverse.append(first[key])
+
+    if len(unique) < len(inverse):
+        print(f"INFO: IPAdapter {len(inverse)} images, {len(unique)} unique ({1 - len(unique) / len(inverse):.0%} duplicates), only the unique images are encoded")
+
+    return torch.tensor(unique), torch.tensor(inverse), hashes
+
+def encode_clip_embeds(clip_vision, image, is_plus, noise, dedup=True, hashes=None):
+    # identical images (and their noisy negatives, which only depend on their source image)
+    # are encoded once and the embeds are copied back to every position
+    if dedup and image.shape[0] > 1:
+        unique, inverse, hashes = unique_images(image)
+        if len(unique) < image.shape[0]:
+            clip_embed, clip_embed_zeroed = encode_clip_embeds(clip_vision, image[unique], is_plus, noise, dedup=False, hashes=hashes)
+            return clip_embed[inverse.to(clip_embed.device)], clip_embed_zeroed[inverse.to(clip_embed_zeroed.device)]
+
+    if noise > 0:
+        noisy = image_add_noise(image, noise, clip_vision.load_device)
+        if image.shape[1:] == noisy.shape[1:]:
+            # images and negative images go through clip vision in a single batch
+            # the noisy images are new, only the hashes of the source images are known
+            noisy_hashes = hashes + [None] * noisy.shape[0] if hashes is not None else None
+            clip_embed, clip_embed_zeroed = encode_image(clip_vision, torch.cat([image.to(noisy.device), noisy]), is_plus, noisy_hashes).split(image.shape[0])
+        else:
+            clip_embed = encode_image(clip_vision, image, is_plus, hashes)
+            clip_embed_zeroed = encode_image(clip_vision, noisy, is_plus)
+        return clip_embed, clip_embed_zeroed
+
+    clip_embed = encode_image(clip_vision, image, is_plus, hashes)
+
+    if is_plus:
+        clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
+    else:
+        clip_embed_zeroed = torch.zeros_like(clip_embed)
+
+    return clip_embed, clip_embed_zeroed
+
+def sinc(x):
+    return torch.where(x == 0, torch.ones_like(x), torch.sin(x * math.pi) / (x * math.pi))
+
+# the same filters (and support) used by PIL
+PIL_FILTERS = {
+    "LANCZOS": (3.0, lambda x: torch.where((x >= -3) & (x < 3), sinc(x) * sinc(x / 3), torch.zeros_like(x))),
+    "BICUBIC": (2.0, lambda x: torch.where(x.abs() < 1, (1.5 * x.abs() - 2.5) * x * x + 1, torch.where(x.abs() < 2, (((x.abs() - 5) * x.abs() + 8) * x.abs() - 4) * -0.5, torch.zeros_like(x)))),
+    "HAMMING": (1.0, lambda x: torch.where(x.abs() < 1, sinc(x) * (0.54 + 0.46 * torch.cos(x * math.pi)), torch.zeros_like(x))),
+    "BILINEAR": (1.0, lambda x: (1 - x.abs()).clamp(min=0)),
+    "BOX": (0.5, lambda x: ((x > -0.5) & (x <= 0.5)).to(x.dtype)),
+}
+
+def resample_weights(in_size, out_size, interpolation, device=None):
+    # [out_size, in_size] matrix that resizes one dimension like PIL does, antialiasing included
+    scale = in_size / out_size
+    center = (torch.arange(out_size, dtype=torch.float64) + 0.5) * scale
+
+    if interpolation == "NEAREST":
+        # PIL accumulates the coordinates with repeated additions, the rounding errors decide the index
+        index, coord = [], scale * 0.5
+        for _ in range(out_size):
+            index.append(min(int(coord), in_size - 1))
+            coord += scale
+        return F.one_hot(torch.tensor(index), in_size).to(device, torch.float32)
+
+    support, fn = PIL_FILTERS[interpolation]
+    filterscale = max(scale, 1.0)
+    support = support * filterscale
+
+    x = torch.arange(in_size, dtype=torch.float64)
+    xmin = (center - support + 0.5).trunc().clamp(min=0)
+    xmax = (center + support + 0.5).trunc().clamp(max=in_size)
+    weights = fn((x[None] - center[:, None] + 0.5) / filterscale)
+    weights = torch.where((x[None] >= xmin[:, None]) & (x[None] < xmax[:, None]), weights, torch.zeros_like(weights))
+    total = weights.sum(dim=1, keepdim=True)
+    weights = torch.where(total != 0, weights / total, weights)
+
+    return weights.to(device, torch.float32)
+
+def resize_batch(image, size, interpolation):
+    # separable resize of a [B, C, H, W] batch with two matrix multiplications. Like the PIL path the
+    # input is truncated to 8 bit, and the horizontal pass is rounded to 8 bit before the vertical one
+    _, _, h, w = image.shape
+    weights_h = resample_weights(h, size, interpolation, image.device)
+    weights_w = resample_weights(w, size, interpolation, image.device)
+    output = (image.float() * 255).floor_().clamp_(0, 255) @ weights_w.T
+    output = weights_h @ output.round_().clamp_(0, 255)
+    return output.round_().clamp_(0, 255) / 255
 
 # From https://github.com/Jamy-L/Pytorch-Contrast-Adaptive-Sharpening/
-def contrast_adaptive_sharpening(image, amount):
-    img = F.pad(image, pad=(1, 1, 1, 1)).cpu()
+def contrast_adaptive_sharpening(image, amount, chunk_size=0):
+    # sharpen chunk_size images at a time to bound the memory (0 = the whole batch at once)
+    chunk_size = chunk_size if chunk_size > 0 else image.shape[0]
+    output = torch.empty_like(image)
+    for start in range(0, image.shape[0], chunk_size):
+        output[start:start+chunk_size] = sharpen_chunk(image[start:start+chunk_size], amount)
+    return output
+
+def sharpen_chunk(image, amount):
+    img = F.pad(image, pad=(1, 1, 1, 1))
 
     a = img[..., :-2, :-2]
     b = img[..., :-2, 1:-1]
@@ -150,30 +455,36 @@ def contrast_adaptive_sharpening(image, amount):
     g = img[..., 2:, :-2]
     h = img[..., 2:, 1:-1]
     i = img[..., 2:, 2:]
-    
-    # Computing contrast
-    cross = (b, d, e, f, h)
-    mn = min_(cross)
-    mx = max_(cross)
-    
-    diag = (a, c, g, i)
-    mn2 = min_(diag)
-    mx2 = max_(diag)
-    mx = mx + mx2
-    mn = mn + mn2
-    
+
+    # Computing contrast, pairwise min/max in three image sized buffers instead of stacking the neighbours
+    mn = torch.minimum(b, d)
+    mx = torch.maximum(b, d)
+    for x in (e, f, h):
+        torch.minimum(mn, x, out=mn)
+        torch.maximum(mx, x, out=mx)
+    mn.clamp_(min=0)
+    mx.clamp_(max=1)
+
+    tmp = torch.minimum(a, c)
+    for x in (g, i):
+        torch.minimum(tmp, x, out=tmp)
+    mn.add_(tmp.clamp_(min=0))
+    torch.maximum(a, c, out=tmp)
+    for x in (g, i):
+        torch.maximum(tmp, x, out=tmp)
+    mx.add_(tmp.clamp_(max=1))
+
     # Computing local weight
-    inv_mx = torch.reciprocal(mx)
-    amp = inv_mx * torch.minimum(mn, (2 - mx))
+    amp = torch.reciprocal(mx, out=tmp)
+    amp.mul_(torch.minimum(mn, mx.neg_().add_(2), out=mn))
 
     # scaling
-    amp = torch.sqrt(amp)
-    w = - amp * (amount * (1/5 - 1/8) + 1/8)
-    div = torch.reciprocal(1 + 4*w)
+    w = amp.sqrt_().mul_(-(amount * (1/5 - 1/8) + 1/8))
+    div = torch.mul(w, 4, out=mn).add_(1).reciprocal_()
 
-    output = ((b + d + f + h)*w + e) * div
-    output = output.clamp(0, 1)
-    output = torch.nan_to_num(output)
+    output = torch.add(b, d, out=mx).add_(f).add_(h).mul_(w).add_(e).mul_(div)
+    output = output.clamp_(0, 1)
+    output = torch.nan_to_num_(output)
 
     return (output)
 
@@ -220,124 +531,393 @@ class IPAdapter(nn.Module):
             )
         return image_proj_model
 
+    def quantize(self, mode):
+        # the image projection and the K/V projections keep their weights in int8/fp8, the
+        # norms, biases and latents stay in full precision
+        quantize_linears(self.image_proj_model, mode)
+        self.ip_layers.quantize(mode)
+
     @torch.inference_mode()
     def get_image_embeds(self, clip_embed, clip_embed_zeroed):
         image_prompt_embeds = self.image_proj_model(clip_embed)
         uncond_image_prompt_embeds = self.image_proj_model(clip_embed_zeroed)
         return image_prompt_embeds, uncond_image_prompt_embeds
 
+# number of built IPAdapter models kept around
+ADAPTER_CACHE_SIZE = 4
+adapter_cache = OrderedDict()
+
+def get_ipadapter(ipadapter, dtype, quantize="none", **kwargs):
+    # changing the weight, weight type or mask doesn't need to build the IPAdapter and
+    # copy it to the device again. The models of the loader are identified by their file (see
+    # checkpoint_key), the entry doesn't keep the checkpoint in memory. Other checkpoints are
+    # identified by their id and kept in the entry so that the id can't be reused
+    checkpoint = ipadapter.get("checkpoint")
+    key = (checkpoint or id(ipadapter), dtype, quantize, tuple(sorted(kwargs.items())))
+
+    if key in adapter_cache:
+        adapter_cache.move_to_end(key)
+        return adapter_cache[key][1]
+
+    # the model is handled by comfy's model management like the other models: it is counted
+    # in the VRAM usage and it can be offloaded when the memory is needed
+    offload_device = comfy.model_management.unet_offload_device()
+    model = IPAdapter(ipadapter, **kwargs)
+    model.to(offload_device, dtype=dtype)
+    if quantize != "none":
+        # after the cast, .to(dtype) would turn the fp8 weights back to the model dtype
+        model.quantize(quantize)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=comfy.model_management.get_torch_device(), offload_device=offload_device)
+
+    adapter_cache[key] = (ipadapter if checkpoint is None else None, patcher)
+    while len(adapter_cache) > ADAPTER_CACHE_SIZE:
+        adapter_cache.popitem(last=False)
+
+    return patcher
+
+def drop_adapters(checkpoint):
+    # the IPAdapters built from a checkpoint go away together with it
+    for key in [key for key in adapter_cache if key[0] == checkpoint]:
+        del adapter_cache[key]
+
+def aggregate_tokens(cond, uncond, mode, token_budget):
+    # collapse the [images, tokens, C] embeds of all the reference images so that the attention cost
+    # doesn't grow with the number of images. The uncond tokens are pooled exactly like the cond
+    # tokens they pair with
+    # the images have no weights here (the IPAdapterEncoder weights are already in the embeds), so
+    # "mean" is the plain per-token mean. The weighted average is the "weighted mean" of the encoder
+    if mode == "mean":
+        return cond.mean(0, keepdim=True), uncond.mean(0, keepdim=True)
+
+    tokens = cond.reshape(-1, cond.shape[-1]).float()
+    uncond_tokens = uncond.reshape(-1, uncond.shape[-1]).float()
+    if tokens.shape[0] <= token_budget:
+        return cond, uncond
+
+    if mode == "top-k":
+        # keep the strongest tokens (the weights of the IPAdapterEncoder scale the embeds down)
+        index = tokens.norm(dim=-1).topk(token_budget).indices.sort().values
+        return cond.reshape(-1, cond.shape[-1])[index].unsqueeze(0), uncond.reshape(-1, uncond.shape[-1])[index].unsqueeze(0)
+
+    # k-means, initialized with tokens evenly spread across the images so that the result is deterministic
+    centroids = tokens[torch.linspace(0, tokens.shape[0] - 1, token_budget, device=tokens.device).long()]
+    for _ in range(10):
+        assign = F.one_hot(torch.cdist(tokens, centroids).argmin(dim=1), token_budget).to(tokens)
+        count = assign.sum(dim=0).unsqueeze(-1)
+        centroids = torch.where(count > 0, (assign.T @ tokens) / count.clamp(min=1), centroids)
+
+    assign = F.one_hot(torch.cdist(tokens, centroids).argmin(dim=1), token_budget).to(tokens)
+    count = assign.sum(dim=0).unsqueeze(-1)
+    keep = count.squeeze(-1) > 0 # empty clusters are dropped
+    cond_centroids = ((assign.T @ tokens) / count.clamp(min=1))[keep]
+    uncond_centroids = ((assign.T @ uncond_tokens) / count.clamp(min=1))[keep]
+    return cond_centroids.unsqueeze(0).to(cond.dtype), uncond_centroids.unsqueeze(0).to(uncond.dtype)
+
+def weight_kv(k, v, weight, weight_type):
+    if weight_type.startswith("linear"):
+        return k * weight, v * weight
+
+    if weight_type.startswith("channel"):
+        # code by Lvmin Zhang at Stanford University as also seen on Fooocus IPAdapter implementation
+        # please read licensing notes https://github.com/lllyasviel/Fooocus/blob/main/fooocus_extras/ip_adapter.py#L225
+        v_mean = torch.mean(v, dim=1, keepdim=True)
+        v_offset = v - v_mean
+        _, _, C = k.shape
+        channel_penalty = float(C) / 1280.0
+        W = weight * channel_penalty
+        return k * W, v_offset + v_mean * W
+
+    return k, v
+
+# the sigmas tensor of the current step and its value. Reading it syncs with the device, so it is
+# read once per step and shared by all the patched layers
+step_sigma = [None, None]
+# older ComfyUI versions don't pass the sigmas to the patches, the warning is printed only once
+sigmas_warning = [False]
+
+def current_sigma(extra_options):
+    if "sigmas" not in extra_options:
+        if not sigmas_warning[0]:
+            sigmas_warning[0] = True
+            print("\033[33mINFO: IPAdapter start_at/end_at need a more recent ComfyUI, the IPAdapter is applied at every step. Please update ComfyUI.\033[0m")
+        return None
+
+    sigmas = extra_options["sigmas"]
+    if step_sigma[0] is not sigmas:
+        step_sigma[:] = [sigmas, sigmas.max().item()]
+    return step_sigma[1]
+
 class CrossAttentionPatch:
     # forward for patching
-    def __init__(self, weight, ipadapter, dtype, number, cond, uncond, weight_type, mask=None):
+    def __init__(self, weight, kv_cache, dtype, number, weight_type, mask=None, fuse=False, sigma_range=None, chunk_size=0):
         self.weights = [weight]
-        self.ipadapters = [ipadapter]
-        self.conds = [cond]
-        self.unconds = [uncond]
+        self.kv_caches = [kv_cache]
+        self.kv_weighted = [None]
         self.dtype = dtype
-        self.device = 'cuda'
         self.number = number
         self.weight_type = [weight_type]
         self.masks = [mask]
+        self.fuse = [fuse]
+        self.sigma_ranges = [sigma_range]
+        self.chunk_sizes = [chunk_size]
+        # number of IP attentions run and skipped because the step is out of the sigma range
+        self.calls = 0
+        self.skipped = 0
+        # optional AttentionProfiler, see IPAdapterProfile
+        self.profiler = None
     
-    def set_new_condition(self, weight, ipadapter, cond, uncond, dtype, number, weight_type, mask=None):
+    def set_new_condition(self, weight, kv_cache, dtype, number, weight_type, mask=None, fuse=False, sigma_range=None, chunk_size=0):
         self.weights.append(weight)
-        self.ipadapters.append(ipadapter)
-        self.conds.append(cond)
-        self.unconds.append(uncond)
+        self.kv_caches.append(kv_cache)
+        self.kv_weighted.append(None)
         self.masks.append(mask)
         self.dtype = dtype
         self.weight_type.append(weight_type)
-        self.device = 'cuda'
+        self.fuse.append(fuse)
+        self.sigma_ranges.append(sigma_range)
+        self.chunk_sizes.append(chunk_size)
+
+    def __deepcopy__(self, memo):
+        # ModelPatcher.clone() deep copies the model options. The cached K/V and masks never
+        # change so the copy shares them instead of duplicating them on the device
+        patch = copy.copy(self)
+        for attr in ("weights", "kv_caches", "kv_weighted", "weight_type", "masks", "fuse", "sigma_ranges", "chunk_sizes"):
+            setattr(patch, attr, list(getattr(self, attr)))
+        # the counters are per model, the copy starts from zero
+        patch.calls = 0
+        patch.skipped = 0
+        return patch
+
+    def get_kv(self, index, cond_or_uncond, batch_prompt, device):
+        # the weighted K/V laid out in the cond_or_uncond order of the batch. Only the [1, tokens, C]
+        # weighted K/V are kept between the steps, in the storage type of the cache, so they take no
+        # more memory than the cache itself. The batch layout is built again at every call
+        if self.kv_weighted[index] is None or self.kv_weighted[index][0] != device:
+            kv_cache = self.kv_caches[index]
+            k_cond, k_uncond, v_cond, v_uncond = kv_cache.get(self.number, kv_cache.dtype, device)
+            # with "original" the weight is applied to the attention output and the cached K/V are used as they are
+            if not self.weight_type[index].startswith("original"):
+                k_cond, k_uncond, v_cond, v_uncond = (kv.to(self.dtype) for kv in (k_cond, k_uncond, v_cond, v_uncond))
+                k_cond, v_cond = weight_kv(k_cond, v_cond, self.weights[index], self.weight_type[index])
+                k_uncond, v_uncond = weight_kv(k_uncond, v_uncond, self.weights[index], self.weight_type[index])
+
+            # multiple reference images are concatenated along the tokens
+            ks = tuple(k.reshape(1, -1, k.shape[-1]).to(kv_cache.dtype) for k in (k_cond, k_uncond))
+            vs = tuple(v.reshape(1, -1, v.shape[-1]).to(kv_cache.dtype) for v in (v_cond, v_uncond))
+            self.kv_weighted[index] = (device, ks, vs)
+
+        _, ks, vs = self.kv_weighted[index]
+
+        # expand() only creates views, a copy is needed only when cond and uncond are in the same batch
+        ip_k = [ks[i].to(self.dtype).expand(batch_prompt, -1, -1) for i in cond_or_uncond]
+        ip_v = [vs[i].to(self.dtype).expand(batch_prompt, -1, -1) for i in cond_or_uncond]
+        ip_k = ip_k[0] if len(ip_k) == 1 else torch.cat(ip_k, dim=0)
+        ip_v = ip_v[0] if len(ip_v) == 1 else torch.cat(ip_v, dim=0)
+
+        return ip_k, ip_v
 
     def __call__(self, n, context_attn2, value_attn2, extra_options):
         org_dtype = n.dtype
         cond_or_uncond = extra_options["cond_or_uncond"]
-        with torch.autocast(device_type=self.device, dtype=self.dtype):
-            q = n
-            k = context_attn2
-            v = value_attn2
-            b = q.shape[0]
-            qs = q.shape[1]
-            batch_prompt = b // len(cond_or_uncond)
+
+        # the inputs are cast to the compute dtype (the cached K/V already are) instead of relying on
+        # autocast, so the patch runs the same on cuda, cpu, mps and xpu
+        q = n.to(self.dtype)
+        k = context_attn2.to(self.dtype)
+        v = value_attn2.to(self.dtype)
+        b = q.shape[0]
+        qs = q.shape[1]
+        batch_prompt = b // len(cond_or_uncond)
+
+        # timed sections when a profiler is attached, otherwise a shared no-op context
+        section = self.profiler.section if self.profiler is not None else no_section
+
+        with section(self.number, None, "attention"):
             out = optimized_attention(q, k, v, extra_options["n_heads"])
-            _, _, lh, lw = extra_options["original_shape"]
+        _, _, lh, lw = extra_options["original_shape"]
 
-            for weight, cond, uncond, ipadapter, mask, weight_type in zip(self.weights, self.conds, self.unconds, self.ipadapters, self.masks, self.weight_type):
-                k_cond = ipadapter.ip_layers.to_kvs[self.number*2](cond).repeat(batch_prompt, 1, 1)
-                k_uncond = ipadapter.ip_layers.to_kvs[self.number*2](uncond).repeat(batch_prompt, 1, 1)
-                v_cond = ipadapter.ip_layers.to_kvs[self.number*2+1](cond).repeat(batch_prompt, 1, 1)
-                v_uncond = ipadapter.ip_layers.to_kvs[self.number*2+1](uncond).repeat(batch_prompt, 1, 1)
+        fused_k = []
+        fused_v = []
 
-                if weight_type.startswith("linear"):
-                    ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0) * weight
-                    ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0) * weight
-                else:
-                    ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
-                    ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
-
-                    if weight_type.startswith("channel"):
-                        # code by Lvmin Zhang at Stanford University as also seen on Fooocus IPAdapter implementation
-                        # please read licensing notes https://github.com/lllyasviel/Fooocus/blob/main/fooocus_extras/ip_adapter.py#L225
-                        ip_v_mean = torch.mean(ip_v, dim=1, keepdim=True)
-                        ip_v_offset = ip_v - ip_v_mean
-                        _, _, C = ip_k.shape
-                        channel_penalty = float(C) / 1280.0
-                        W = weight * channel_penalty
-                        ip_k = ip_k * W
-                        ip_v = ip_v_offset + ip_v_mean * W
-
-                out_ip = optimized_attention(q, ip_k, ip_v, extra_options["n_heads"])           
-                if weight_type.startswith("original"):
-                    out_ip = out_ip * weight
+        sigma = None
+        if any(sigma_range is not None for sigma_range in self.sigma_ranges):
+            sigma = current_sigma(extra_options)
 
-                if mask is not None:
-                    # TODO: needs testing
-                    for rate in [1, 2, 4, 8]:
-                        mask_h = -(-lh//rate) # fancy ceil
-                        mask_w = -(-lw//rate)
+        fused_chunk_sizes = []
+
+        for index, (weight, mask, weight_type, fuse, sigma_range, chunk_size) in enumerate(zip(self.weights, self.masks, self.weight_type, self.fuse, self.sigma_ranges, self.chunk_sizes)):
+            if sigma is not None and sigma_range is not None and not (sigma_range[1] <= sigma <= sigma_range[0]):
+                self.skipped += 1
+                continue
+
+            self.calls += 1
+            with section(self.number, index, "ip_kv"):
+                ip_k, ip_v = self.get_kv(index, cond_or_uncond, batch_prompt, q.device)
+
+            # with linear and channel penalty the weight is already in the K/V, so unmasked adapters
+            # can be concatenated along the tokens (like a batch of images) and share one attention call
+            if fuse and mask is None and not weight_type.startswith("original"):
+                fused_k.append(ip_k)
+                fused_v.append(ip_v)
+                fused_chunk_sizes.append(chunk_size)
+                continue
 
-                        if mask_h*mask_w == qs:
-                            break
-                    
-                    mask_downsample = F.interpolate(mask.unsqueeze(0).unsqueeze(0), size=(mask_h, mask_w), mode="bilinear").squeeze(0)
-                    mask_downsample = mask_downsample.view(1, -1, 1).repeat(out.shape[0], 1, out.shape[2])
-                    out_ip = out_ip * mask_downsample
+            weight = weight if weight_type.startswith("original") else 1.0
+            chunked = chunk_size > 0 and chunk_size < qs
+            mask_downsample = active = None
 
-                out = out + out_ip
+            if mask is not None:
+                with section(self.number, index, "mask"):
+                    mask_downsample = mask.get(lh, lw, qs, batch_prompt, cond_or_uncond, out.dtype)
+                    active = mask.active_chunks(lh, lw, qs, batch_prompt, cond_or_uncond, out.dtype, chunk_size) if chunked else None
+
+            with section(self.number, index, "ip_attention"):
+                if chunked:
+                    add_ip_attention_chunked(out, q, ip_k, ip_v, extra_options["n_heads"], weight, mask_downsample, chunk_size, active)
+                    continue
+
+                out_ip = optimized_attention(q, ip_k, ip_v, extra_options["n_heads"])
+
+                if mask is not None:
+                    out.addcmul_(out_ip, mask_downsample, value=weight)
+                else:
+                    out.add_(out_ip, alpha=weight)
+                # freed before the attention of the next adapter, otherwise two are alive at the peak
+                del out_ip
+
+        if fused_k:
+            with section(self.number, None, "fused_attention"):
+                ip_k, ip_v = torch.cat(fused_k, dim=1), torch.cat(fused_v, dim=1)
+                chunk_size = min([chunk_size for chunk_size in fused_chunk_sizes if chunk_size > 0], default=0)
+                if chunk_size > 0 and chunk_size < qs:
+                    add_ip_attention_chunked(out, q, ip_k, ip_v, extra_options["n_heads"], 1.0, None, chunk_size)
+                else:
+                    out.add_(optimized_attention(q, ip_k, ip_v, extra_options["n_heads"]))
 
         return out.to(dtype=org_dtype)
 
+def add_ip_attention_chunked(out, q, ip_k, ip_v, heads, weight, mask, chunk_size, active=None):
+    # the IP attention of chunk_size query tokens at a time, added to out in place so that the peak
+    # memory doesn't grow with the resolution. The chunks where the mask is all zeros are skipped
+    for i, start in enumerate(range(0, q.shape[1], chunk_size)):
+        if active is not None and not active[i]:
+            continue
+
+        end = start + chunk_size
+        out_ip = optimized_attention(q[:, start:end], ip_k, ip_v, heads)
+        if mask is not None:
+            out[:, start:end].addcmul_(out_ip, mask[:, start:end], value=weight)
+        else:
+            out[:, start:end].add_(out_ip, alpha=weight)
+
+def get_attention_patches(model):
+    patches = model.model_options["transformer_options"].get("patches_replace", {}).get("attn2", {}).values()
+    return [patch for patch in patches if isinstance(patch, CrossAttentionPatch)]
+
+def ip_attention_stats(model):
+    # IP attention calls run and skipped by all the patches of a model
+    patches = get_attention_patches(model)
+    return {"calls": sum(patch.calls for patch in patches), "skipped": sum(patch.skipped for patch in patches)}
+
+def load_ipadapter_file(ckpt_path):
+    model = comfy.utils.load_torch_file(ckpt_path, safe_load=True)
+
+    if ckpt_path.lower().endswith(".safetensors"):
+        st_model = {"image_proj": {}, "ip_adapter": {}}
+        for key in model.keys():
+            if key.startswith("image_proj."):
+                st_model["image_proj"][key.replace("image_proj.", "")] = model[key]
+            elif key.startswith("ip_adapter."):
+                st_model["ip_adapter"][key.replace("ip_adapter.", "")] = model[key]
+        # sort keys
+        model = {"image_proj": st_model["image_proj"], "ip_adapter": {}}
+        sorted_keys = sorted(st_model["ip_adapter"].keys(), key=lambda x: int(x.split(".")[0]))
+        for key in sorted_keys:
+            model["ip_adapter"][key] = st_model["ip_adapter"][key]
+        st_model = None
+
+    if not "ip_adapter" in model.keys() or not model["ip_adapter"]:
+        raise Exception("invalid IPAdapter model {}".format(ckpt_path))
+
+    return model
+
+def checkpoint_key(ckpt_path):
+    # identifies a version of a model file
+    stat = os.stat(ckpt_path)
+    return (os.path.realpath(ckpt_path), stat.st_mtime_ns, stat.st_size)
+
+class ModelCache:
+    # process wide LRU of the loaded IPAdapter models so that switching between a few of them
+    # doesn't read them from disk every time. The returned models are shared, do not modify them
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, ckpt_path):
+        key = checkpoint_key(ckpt_path)
+
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key][0]
+
+        self.misses += 1
+        # drop older versions of the same file
+        for old_key in [k for k in self.models if k[0] == key[0]]:
+            self.size -= self.models.pop(old_key)[1]
+            drop_adapters(old_key)
+
+        # also make room in system memory for the model that is about to be loaded
+        self.free_memory(key[2] - psutil.virtual_memory().available)
+        model = load_ipadapter_file(ckpt_path)
+        size = sum(t.nbytes for sd in model.values() for t in sd.values())
+
+        if size <= self.max_bytes:
+            self.free_memory(self.size + size - self.max_bytes)
+            self.models[key] = (model, size)
+            self.size += size
+
+        return model
+
+    def free_memory(self, memory_required):
+        # evict the least recently used models until at least memory_required bytes are freed
+        freed = 0
+        while self.models and freed < memory_required:
+            key, (_, size) = self.models.popitem(last=False)
+            drop_adapters(key)
+            self.size -= size
+            freed += size
+        return freed
+
+    def clear(self):
+        return self.free_memory(self.size)
+
+model_cache = ModelCache(MODEL_CACHE_SIZE * 1024 * 1024)
+
 class IPAdapterModelLoader:
     @classmethod
     def INPUT_TYPES(s):
-        return {"required": { "ipadapter_file": (get_filename_list(MODELS_DIR), )}}
+        return {
+            "required": { "ipadapter_file": (get_filename_list(MODELS_DIR), )},
+            "optional": { "quantize": (["none"] + list(QUANTIZE_DTYPES), )},
+        }
 
     RETURN_TYPES = ("IPADAPTER",)
     FUNCTION = "load_ipadapter_model"
 
     CATEGORY = "ipadapter"
 
-    def load_ipadapter_model(self, ipadapter_file):
+    def load_ipadapter_model(self, ipadapter_file, quantize="none"):
         ckpt_path = os.path.join(MODELS_DIR, ipadapter_file)
+        model = model_cache.load(ckpt_path)
 
-        model = comfy.utils.load_torch_file(ckpt_path, safe_load=True)
-
-        if ckpt_path.lower().endswith(".safetensors"):
-            st_model = {"image_proj": {}, "ip_adapter": {}}
-            for key in model.keys():
-                if key.startswith("image_proj."):
-                    st_model["image_proj"][key.replace("image_proj.", "")] = model[key]
-                elif key.startswith("ip_adapter."):
-                    st_model["ip_adapter"][key.replace("ip_adapter.", "")] = model[key]
-            # sort keys
-            model = {"image_proj": st_model["image_proj"], "ip_adapter": {}}
-            sorted_keys = sorted(st_model["ip_adapter"].keys(), key=lambda x: int(x.split(".")[0]))
-            for key in sorted_keys:
-                model["ip_adapter"][key] = st_model["ip_adapter"][key]
-            st_model = None
-
-        if not "ip_adapter" in model.keys() or not model["ip_adapter"]:
-            raise Exception("invalid IPAdapter model {}".format(ckpt_path))
+        # the cached model is shared, the file and the storage mode go in a new dict
+        model = {**model, "checkpoint": checkpoint_key(ckpt_path)}
+        if quantize != "none":
+            model["quantize"] = quantize
 
         return (model,)
 
@@ -356,6 +936,15 @@ class IPAdapterApply:
             },
             "optional": {
                 "attn_mask": ("MASK",),
+                "fuse": ("BOOLEAN", { "default": False }),
+                "aggregate": (["none", "mean", "k-means", "top-k"],),
+                "token_budget": ("INT", { "default": 16, "min": 1, "max": 1024 }),
+                "start_at": ("FLOAT", { "default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001 }),
+                "end_at": ("FLOAT", { "default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001 }),
+                "blocks": (["all", "input", "middle", "output", "input+middle", "input+output", "middle+output"],),
+                "chunk_size": ("INT", { "default": 0, "min": 0, "max": 262144, "step": 256 }),
+                "kv_cache_dtype": (list(KV_CACHE_DTYPES), ),
+                "dedup": ("BOOLEAN", { "default": True }),
             }
         }
 
@@ -363,7 +952,7 @@ class IPAdapterApply:
     FUNCTION = "apply_ipadapter"
     CATEGORY = "ipadapter"
 
-    def apply_ipadapter(self, ipadapter, model, weight, clip_vision=None, image=None, weight_type="original", noise=None, embeds=None, attn_mask=None):
+    def apply_ipadapter(self, ipadapter, model, weight, clip_vision=None, image=None, weight_type="original", noise=None, embeds=None, attn_mask=None, fuse=False, aggregate="none", token_budget=16, start_at=0.0, end_at=1.0, blocks="all", chunk_size=0, kv_cache_dtype="auto", dedup=True):
         self.dtype = model.model.diffusion_model.dtype
         self.device = comfy.model_management.get_torch_device()
         self.weight = weight
@@ -383,26 +972,13 @@ class IPAdapterApply:
             if image.shape[1] != image.shape[2]:
                 print("\033[33mINFO: the IPAdapter reference image is not a square, CLIPImageProcessor will resize and crop it at the center. If the main focus of the picture is not in the middle the result might not be what you are expecting.\033[0m")
 
-            clip_embed = clip_vision.encode_image(image)
-            neg_image = image_add_noise(image, noise) if noise > 0 else None
-            
-            if self.is_plus:
-                clip_embed = clip_embed.penultimate_hidden_states
-                if noise > 0:
-                    clip_embed_zeroed = clip_vision.encode_image(neg_image).penultimate_hidden_states
-                else:
-                    clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
-            else:
-                clip_embed = clip_embed.image_embeds
-                if noise > 0:
-                    clip_embed_zeroed = clip_vision.encode_image(neg_image).image_embeds
-                else:
-                    clip_embed_zeroed = torch.zeros_like(clip_embed)
+            clip_embed, clip_embed_zeroed = encode_clip_embeds(clip_vision, image, self.is_plus, noise, dedup=dedup)
 
         clip_embeddings_dim = clip_embed.shape[-1]
 
-        self.ipadapter = IPAdapter(
+        ipadapter_patcher = get_ipadapter(
             ipadapter,
+            self.dtype,
             cross_attention_dim=cross_attention_dim,
             output_cross_attention_dim=output_cross_attention_dim,
             clip_embeddings_dim=clip_embeddings_dim,
@@ -410,52 +986,60 @@ class IPAdapterApply:
             is_sdxl=self.is_sdxl,
             is_plus=self.is_plus,
             is_full=self.is_full,
+            quantize=ipadapter.get("quantize", "none"),
         )
-        
-        self.ipadapter.to(self.device, dtype=self.dtype)
+
+        # the IPAdapter is only needed here, the sampling uses the cached K/V
+        comfy.model_management.load_model_gpu(ipadapter_patcher)
+        self.ipadapter = ipadapter_patcher.model
 
         image_prompt_embeds, uncond_image_prompt_embeds = self.ipadapter.get_image_embeds(clip_embed.to(self.device, self.dtype), clip_embed_zeroed.to(self.device, self.dtype))
         image_prompt_embeds = image_prompt_embeds.to(self.device, dtype=self.dtype)
         uncond_image_prompt_embeds = uncond_image_prompt_embeds.to(self.device, dtype=self.dtype)
 
+        if aggregate != "none":
+            image_prompt_embeds, uncond_image_prompt_embeds = aggregate_tokens(image_prompt_embeds, uncond_image_prompt_embeds, aggregate, token_budget)
+
+        if not self.is_sdxl:
+            layers = [("input", ("input", id)) for id in [1,2,4,5,7,8]] # id of input_blocks that have cross attention
+            layers += [("output", ("output", id)) for id in [3,4,5,6,7,8,9,10,11]] # id of output_blocks that have cross attention
+            layers += [("middle", ("middle", 0))]
+        else:
+            layers = [("input", ("input", id, index)) for id in [4,5,7,8] for index in (range(2) if id in [4, 5] else range(10))] # id of input_blocks that have cross attention, transformer_depth
+            layers += [("output", ("output", id, index)) for id in range(6) for index in (range(2) if id in [3, 4, 5] else range(10))] # id of output_blocks that have cross attention, transformer_depth
+            layers += [("middle", ("middle", 0, index)) for index in range(10)]
+
+        # the layers are numbered in the order of the IPAdapter projections, only the selected blocks are patched
+        layers = [(number, key) for number, (block, key) in enumerate(layers) if blocks == "all" or block in blocks.split("+")]
+
+        # kv_cache_dtype can be set to a smaller type (eg: fp16) to bound the memory used by the cache
+        kv_cache = KVCache(self.ipadapter, image_prompt_embeds, uncond_image_prompt_embeds, dtype=KV_CACHE_DTYPES[kv_cache_dtype], numbers=[number for number, _ in layers])
+
         work_model = model.clone()
 
         if attn_mask is not None:
-            attn_mask = attn_mask.squeeze().to(self.device)
-        
+            attn_mask = MaskPyramid(attn_mask.to(self.device))
+
+        # IP attention only runs between the sigmas of start_at and end_at
+        sigma_range = None
+        if start_at > 0.0 or end_at < 1.0:
+            model_sampling = model.model.model_sampling
+            sigma_range = (model_sampling.percent_to_sigma(start_at), model_sampling.percent_to_sigma(end_at))
+
         patch_kwargs = {
-            "number": 0,
             "weight": self.weight,
-            "ipadapter": self.ipadapter,
+            "kv_cache": kv_cache,
             "dtype": self.dtype,
-            "cond": image_prompt_embeds,
-            "uncond": uncond_image_prompt_embeds,
             "weight_type": weight_type,
-            "mask": attn_mask
+            "mask": attn_mask,
+            "fuse": fuse,
+            "sigma_range": sigma_range,
+            # query tokens per slice of the IP attention, 0 = all at once
+            "chunk_size": chunk_size,
         }
 
-        if not self.is_sdxl:
-            for id in [1,2,4,5,7,8]: # id of input_blocks that have cross attention
-                set_model_patch_replace(work_model, patch_kwargs, ("input", id))
-                patch_kwargs["number"] += 1
-            for id in [3,4,5,6,7,8,9,10,11]: # id of output_blocks that have cross attention
-                set_model_patch_replace(work_model, patch_kwargs, ("output", id))
-                patch_kwargs["number"] += 1
-            set_model_patch_replace(work_model, patch_kwargs, ("middle", 0))
-        else:
-            for id in [4,5,7,8]: # id of input_blocks that have cross attention
-                block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(work_model, patch_kwargs, ("input", id, index))
-                    patch_kwargs["number"] += 1
-            for id in range(6): # id of output_blocks that have cross attention
-                block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
-                for index in block_indices:
-                    set_model_patch_replace(work_model, patch_kwargs, ("output", id, index))
-                    patch_kwargs["number"] += 1
-            for index in range(10):
-                set_model_patch_replace(work_model, patch_kwargs, ("midlle", 0, index))
-                patch_kwargs["number"] += 1
+        for number, key in layers:
+            set_model_patch_replace(work_model, {**patch_kwargs, "number": number}, key)
 
         return (work_model, )
 
@@ -469,6 +1053,9 @@ class PrepImageForClipVision:
             "crop_position": (["top", "bottom", "left", "right", "center"],),
             "sharpening": ("FLOAT", {"default": 0.0, "min": 0, "max": 1, "step": 0.05}),
             },
+            "optional": {
+                "backend": (["PIL", "torch", "torch gpu"],),
+            }
         }
 
     RETURN_TYPES = ("IMAGE",)
@@ -476,7 +1063,7 @@ class PrepImageForClipVision:
 
     CATEGORY = "ipadapter"
 
-    def prep_image(self, image, padding, interpolation="LANCZOS", crop_position="center", sharpening=0.0):
+    def prep_image(self, image, padding, interpolation="LANCZOS", crop_position="center", sharpening=0.0, backend="PIL"):
         #add padding to image
         if padding:
             image = pad_to_square(image)     
@@ -504,17 +1091,23 @@ class PrepImageForClipVision:
         output = output.permute([0,3,1,2])
 
         # resize (apparently PIL resize is better than tourchvision interpolate)
-        imgs = []
-        for i in range(output.shape[0]):
-            img = TT.ToPILImage()(output[i])
-            img = img.resize((224,224), resample=Image.Resampling[interpolation])
-            imgs.append(TT.ToTensor()(img))
-        output = torch.stack(imgs, dim=0)
+        if backend == "PIL":
+            imgs = []
+            for i in range(output.shape[0]):
+                img = TT.ToPILImage()(output[i])
+                img = img.resize((224,224), resample=Image.Resampling[interpolation])
+                imgs.append(TT.ToTensor()(img))
+            output = torch.stack(imgs, dim=0)
+        else:
+            # same filters as PIL on the whole batch at once, the result differs from PIL by at most 2/255
+            if backend == "torch gpu":
+                output = output.to(comfy.model_management.get_torch_device())
+            output = resize_batch(output, 224, interpolation)
        
         if sharpening > 0:
             output = contrast_adaptive_sharpening(output, sharpening)
         
-        output = output.permute([0,2,3,1])
+        output = output.permute([0,2,3,1]).cpu()
 
         return (output,)
 
@@ -535,6 +1128,10 @@ class IPAdapterEncoder:
                 "weight_2": ("FLOAT", { "default": 1.0, "min": 0, "max": 1.0, "step": 0.01 }),
                 "weight_3": ("FLOAT", { "default": 1.0, "min": 0, "max": 1.0, "step": 0.01 }),
                 "weight_4": ("FLOAT", { "default": 1.0, "min": 0, "max": 1.0, "step": 0.01 }),
+                "batch_size": ("INT", { "default": 0, "min": 0, "max": 4096 }),
+                "mmap_output": ("BOOLEAN", { "default": False }),
+                "aggregate": (["none", "weighted mean"],),
+                "dedup": ("BOOLEAN", { "default": True }),
             }
         }
 
@@ -542,7 +1139,7 @@ class IPAdapterEncoder:
     FUNCTION = "preprocess"
     CATEGORY = "ipadapter"
 
-    def preprocess(self, clip_vision, image_1, ipadapter_plus, noise, weight_1, image_2=None, image_3=None, image_4=None, weight_2=1.0, weight_3=1.0, weight_4=1.0):
+    def preprocess(self, clip_vision, image_1, ipadapter_plus, noise, weight_1, image_2=None, image_3=None, image_4=None, weight_2=1.0, weight_3=1.0, weight_4=1.0, batch_size=0, mmap_output=False, aggregate="none", dedup=True):
         weight_1 *= (0.1 + (weight_1 - 0.1))
         weight_1 = 1.19e-05 if weight_1 <= 1.19e-05 else weight_1
         weight_2 *= (0.1 + (weight_2 - 0.1))
@@ -571,27 +1168,48 @@ class IPAdapterEncoder:
             image = torch.cat((image, image_4), dim=0)
             weight += [weight_4]*image_4.shape[0]
         
-        clip_embed = clip_vision.encode_image(image)
-        neg_image = image_add_noise(image, noise) if noise > 0 else None
-        
-        if ipadapter_plus:
-            clip_embed = clip_embed.penultimate_hidden_states
-            if noise > 0:
-                clip_embed_zeroed = clip_vision.encode_image(neg_image).penultimate_hidden_states
-            else:
-                clip_embed_zeroed = zeroed_hidden_states(clip_vision, image.shape[0])
+        weight = torch.tensor(weight) if any(e != 1.0 for e in weight) else None
+        output = None
+
+        # the same image is often sent more than once (eg: the same source in several slots or
+        # repeated video frames), only the unique images are encoded. Finding them hashes every
+        # image, dedup=False skips it when the images are known to be all different
+        if dedup:
+            unique, inverse, hashes = unique_images(image)
         else:
-            clip_embed = clip_embed.image_embeds
-            if noise > 0:
-                clip_embed_zeroed = clip_vision.encode_image(neg_image).image_embeds
-            else:
-                clip_embed_zeroed = torch.zeros_like(clip_embed)
-
-        if any(e != 1.0 for e in weight):
-            weight = torch.tensor(weight).unsqueeze(-1) if not ipadapter_plus else torch.tensor(weight).unsqueeze(-1).unsqueeze(-1)
-            clip_embed = clip_embed * weight
-        
-        output = torch.stack((clip_embed, clip_embed_zeroed))
+            unique = inverse = torch.arange(image.shape[0])
+            hashes = None
+        batch_size = batch_size if batch_size > 0 else len(unique)
+
+        # encode batch_size images at a time straight into the output, so that long batches don't need
+        # to go through clip vision (and be kept in memory) all at once
+        for start in range(0, len(unique), batch_size):
+            end = start + batch_size
+            clip_embed, clip_embed_zeroed = encode_clip_embeds(clip_vision, image[unique[start:end]], ipadapter_plus, noise, dedup=False, hashes=hashes[start:end] if hashes is not None else None)
+
+            # every position whose image is in this chunk
+            positions = ((inverse >= start) & (inverse < end)).nonzero().squeeze(1)
+            source = (inverse[positions] - start).to(clip_embed.device)
+            clip_embed = clip_embed[source]
+            clip_embed_zeroed = clip_embed_zeroed[source.to(clip_embed_zeroed.device)]
+
+            if weight is not None:
+                clip_embed = clip_embed * weight[positions].view(-1, *[1] * (clip_embed.dim() - 1)).to(clip_embed.device)
+
+            if output is None:
+                shape = (2, image.shape[0]) + clip_embed.shape[1:]
+                dtype = torch.promote_types(clip_embed.dtype, clip_embed_zeroed.dtype)
+                output = empty_embeds(shape, dtype, mmap_output, clip_embed.device)
+
+            positions = positions.to(output.device)
+            output[0, positions] = clip_embed
+            output[1, positions] = clip_embed_zeroed
+
+        if aggregate == "weighted mean":
+            # a single embedding for all the images, the cond embeds are already multiplied by the weights
+            weight = weight if weight is not None else torch.ones(image.shape[0])
+            weight = weight.view(-1, *[1] * (output.dim() - 2)).to(output)
+            output = torch.stack((output[0].sum(dim=0, keepdim=True), (output[1] * weight).sum(dim=0, keepdim=True))) / weight.sum()
 
         return( output, )
 
@@ -608,9 +1226,82 @@ class IPAdapterApplyEncoded(IPAdapterApply):
             },
             "optional": {
                 "attn_mask": ("MASK",),
+                "fuse": ("BOOLEAN", { "default": False }),
+                "aggregate": (["none", "mean", "k-means", "top-k"],),
+                "token_budget": ("INT", { "default": 16, "min": 1, "max": 1024 }),
+                "start_at": ("FLOAT", { "default": 0.0, "min": 0.0, "max": 1.0, "step": 0.001 }),
+                "end_at": ("FLOAT", { "default": 1.0, "min": 0.0, "max": 1.0, "step": 0.001 }),
+                "blocks": (["all", "input", "middle", "output", "input+middle", "input+output", "middle+output"],),
+                "chunk_size": ("INT", { "default": 0, "min": 0, "max": 262144, "step": 256 }),
+                "kv_cache_dtype": (list(KV_CACHE_DTYPES), ),
             }
         }
 
+def save_embeds(file, embeds, fp16=False):
+    cond, uncond = embeds[0], embeds[1]
+    if fp16:
+        cond, uncond = cond.half(), uncond.half()
+
+    # with noise=0 all the uncond embeds are the same, only one is saved
+    uncond_shared = uncond.shape[0] > 1 and bool((uncond == uncond[:1]).all())
+    if uncond_shared:
+        uncond = uncond[:1]
+
+    metadata = {
+        "format": "ipadapter_embeds",
+        "version": "1",
+        "ipadapter_plus": str(cond.dim() == 3).lower(),
+        "images": str(cond.shape[0]),
+        "clip_embeddings_dim": str(cond.shape[-1]),
+        "uncond_shared": str(uncond_shared).lower(),
+        "dtype": str(cond.dtype).replace("torch.", ""),
+    }
+    save_file({"cond": cond.contiguous().cpu(), "uncond": uncond.contiguous().cpu()}, file, metadata=metadata)
+
+def read_embeds_metadata(path):
+    if not path.endswith(".safetensors"):
+        return {"format": "ipadapter_embeds_legacy"}
+
+    with safe_open(path, framework="pt") as f:
+        return f.metadata() or {}
+
+def load_embeds(path):
+    if not path.endswith(".safetensors"):
+        return torch.load(path, map_location="cpu", weights_only=True)
+
+    # safetensors memory maps the file and reads only the tensors data, nothing gets unpickled
+    with safe_open(path, framework="pt") as f:
+        cond = f.get_tensor("cond")
+        uncond = f.get_tensor("uncond")
+
+    return torch.stack((cond, uncond.expand_as(cond)))
+
+def empty_embeds(shape, dtype, mmap=False, device=None):
+    if not mmap:
+        return torch.empty(shape, dtype=dtype, device=device)
+
+    # the tensor is backed by a file in the temp directory instead of the RAM
+    temp_dir = folder_paths.get_temp_directory()
+    os.makedirs(temp_dir, exist_ok=True)
+    fd, filename = tempfile.mkstemp(suffix=".ipadpt.tmp", dir=temp_dir)
+    size = math.prod(shape)
+    os.ftruncate(fd, size * torch.empty((), dtype=dtype).element_size())
+    os.close(fd)
+    output = torch.from_file(filename, shared=True, size=size, dtype=dtype).view(shape)
+
+    try:
+        # the mapping stays valid after the file is removed (except on windows, the temp directory
+        # is cleared when comfyui starts)
+        os.remove(filename)
+    except OSError:
+        pass
+
+    return output
+
+def get_embeds_index():
+    # the input directory can hold many thousands of files, only the directories that changed are listed again
+    return get_file_index(folder_paths.get_input_directory(), EMBEDS_EXTENSIONS, metadata=read_embeds_metadata)
+
 class IPAdapterSaveEmbeds:
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
@@ -621,6 +1312,9 @@ class IPAdapterSaveEmbeds:
             "embeds": ("EMBEDS",),
             "filename_prefix": ("STRING", {"default": "embeds/IPAdapter"})
             },
+            "optional": {
+                "fp16": ("BOOLEAN", {"default": False}),
+            }
         }
 
     RETURN_TYPES = ()
@@ -628,21 +1322,20 @@ class IPAdapterSaveEmbeds:
     OUTPUT_NODE = True
     CATEGORY = "ipadapter"
 
-    def save(self, embeds, filename_prefix):
+    def save(self, embeds, filename_prefix, fp16=False):
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir)
-        file = f"{filename}_{counter:05}_.ipadpt"
+        file = f"{filename}_{counter:05}_.ipadpt.safetensors"
         file = os.path.join(full_output_folder, file)
 
-        torch.save(embeds, file)
+        save_embeds(file, embeds, fp16)
         return (None, )
 
 
 class IPAdapterLoadEmbeds:
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [os.path.relpath(os.path.join(root, file), input_dir) for root, dirs, files in os.walk(input_dir) for file in files if file.endswith('.ipadpt')]
-        return {"required": {"embeds": [sorted(files), ]}, }
+        files = get_embeds_index().list()
+        return {"required": {"embeds": [files, ]}, }
 
     RETURN_TYPES = ("EMBEDS", )
     FUNCTION = "load"
@@ -650,10 +1343,74 @@ class IPAdapterLoadEmbeds:
 
     def load(self, embeds):
         path = folder_paths.get_annotated_filepath(embeds)
-        output = torch.load(path).cpu()
+        output = load_embeds(path)
 
         return (output, )
 
+class IPAdapterProfile:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "model": ("MODEL", ),
+            "backend": (["perf_counter", "cuda events"], ),
+            "memory": ("BOOLEAN", { "default": False }),
+            }
+        }
+
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "profile"
+    CATEGORY = "ipadapter"
+
+    def profile(self, model, backend, memory):
+        # the patches of the cloned model are copies, the profiler is only attached to this model
+        work_model = model.clone()
+        profiler = AttentionProfiler("cuda" if backend == "cuda events" else "perf_counter", memory, comfy.model_management.get_torch_device())
+        for patch in get_attention_patches(work_model):
+            patch.profiler = profiler
+
+        return (work_model, )
+
+class IPAdapterProfileReport:
+    def __init__(self):
+        self.output_dir = folder_paths.get_output_directory()
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "model": ("MODEL", ),
+            # only used to run the report after the sampling
+            "latent": ("LATENT", ),
+            "save_trace": ("BOOLEAN", { "default": True }),
+            "filename_prefix": ("STRING", {"default": "ipadapter/trace"}),
+            }
+        }
+
+    RETURN_TYPES = ("STRING",)
+    FUNCTION = "report"
+    OUTPUT_NODE = True
+    CATEGORY = "ipadapter"
+
+    def report(self, model, latent, save_trace=True, filename_prefix="ipadapter/trace"):
+        patches = get_attention_patches(model)
+        profiler = next((patch.profiler for patch in patches if patch.profiler is not None), None)
+        if profiler is None:
+            return ("the model has no IPAdapter profiler, add an IPAdapterProfile node before the sampler", )
+
+        stats = ip_attention_stats(model)
+        summary = profiler.format_summary() + f"\nIP attention calls: {stats['calls']}, skipped: {stats['skipped']}"
+        print(summary)
+
+        if save_trace:
+            full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path(filename_prefix, self.output_dir)
+            profiler.save_chrome_trace(os.path.join(full_output_folder, f"{filename}_{counter:05}_.json"))
+
+        # the next sampling run starts from scratch
+        profiler.reset()
+        for patch in patches:
+            patch.calls = 0
+            patch.skipped = 0
+        return (summary, )
+
 NODE_CLASS_MAPPINGS = {
     "IPAdapterModelLoader": IPAdapterModelLoader,
     "IPAdapterApply": IPAdapterApply,
@@ -662,6 +1419,8 @@ NODE_CLASS_MAPPINGS = {
     "IPAdapterEncoder": IPAdapterEncoder,
     "IPAdapterSaveEmbeds": IPAdapterSaveEmbeds,
     "IPAdapterLoadEmbeds": IPAdapterLoadEmbeds,
+    "IPAdapterProfile": IPAdapterProfile,
+    "IPAdapterProfileReport": IPAdapterProfileReport,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -672,4 +1431,6 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "IPAdapterEncoder": "Encode IPAdapter Image",
     "IPAdapterSaveEmbeds": "Save IPAdapter Embeds",
     "IPAdapterLoadEmbeds": "Load IPAdapter Embeds",
+    "IPAdapterProfile": "Profile IPAdapter",
+    "IPAdapterProfileReport": "IPAdapter Profile Report",
 }
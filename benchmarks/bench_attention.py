@@ -0,0 +1,65 @@
+# CrossAttentionPatch.__call__ of one layer with the SD1.5 and SDXL shapes, 1-4 stacked IPAdapters
+#   python benchmarks/bench_attention.py
+import json
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.common import timeit, load_ipadapter_plus
+
+# first cross attention layer at 512x512 (SD1.5) and 1024x1024 (SDXL)
+SHAPES = {
+    "sd15": dict(latent=64, rate=1, channels=320, heads=8, tokens=4),
+    "sdxl": dict(latent=128, rate=2, channels=640, heads=10, tokens=4),
+}
+
+class StaticKV:
+    # stand-in for the KVCache of an applied IPAdapter, only the patch is timed
+    def __init__(self, tokens, channels):
+        self.kv = [torch.randn(1, tokens, channels) for _ in range(4)]
+        self.dtype = torch.float32
+
+    def get(self, number, dtype, device=None):
+        return tuple(kv.to(device, dtype) for kv in self.kv)
+
+def build_patch(ipadapter, adapters, shape, masked):
+    mask = None
+    if masked:
+        # the left half of the image
+        mask = torch.zeros(1, shape["latent"] * 8, shape["latent"] * 8)
+        mask[..., :shape["latent"] * 4] = 1
+        mask = ipadapter.MaskPyramid(mask)
+
+    patch = None
+    for _ in range(adapters):
+        kwargs = dict(weight=0.8, kv_cache=StaticKV(shape["tokens"], shape["channels"]), dtype=torch.float32, number=0, weight_type="original", mask=mask)
+        if patch is None:
+            patch = ipadapter.CrossAttentionPatch(**kwargs)
+        else:
+            patch.set_new_condition(**kwargs)
+    return patch
+
+@torch.inference_mode()
+def run(repeat=5, batch_size=1):
+    ipadapter = load_ipadapter_plus()
+    results = []
+    for name, shape in SHAPES.items():
+        side = shape["latent"] // shape["rate"]
+        q = torch.randn(batch_size * 2, side * side, shape["channels"])
+        context = torch.randn(batch_size * 2, 77, shape["channels"])
+        extra_options = {
+            "cond_or_uncond": [1, 0],
+            "n_heads": shape["heads"],
+            "original_shape": [batch_size * 2, 4, shape["latent"], shape["latent"]],
+        }
+        for adapters in (1, 2, 4):
+            for masked in (False, True):
+                patch = build_patch(ipadapter, adapters, shape, masked)
+                label = f"attention_patch[{name},adapters={adapters},mask={str(masked).lower()}]"
+                results.append({"name": label, **timeit(lambda: patch(q, context, context, extra_options), repeat)})
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
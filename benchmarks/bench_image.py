@@ -0,0 +1,31 @@
+# PrepImageForClipVision.prep_image (PIL and torch backends) and contrast_adaptive_sharpening
+#   python benchmarks/bench_image.py
+import json
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.common import timeit, load_ipadapter_plus
+
+@torch.inference_mode()
+def run(repeat=5, batch_sizes=(1, 16, 64)):
+    ipadapter = load_ipadapter_plus()
+    results = []
+
+    node = ipadapter.PrepImageForClipVision()
+    for batch_size in batch_sizes:
+        image = torch.rand(batch_size, 512, 768, 3)
+        for backend in ("PIL", "torch"):
+            for sharpening in (0.0, 0.5):
+                label = f"prep_image[{backend},batch={batch_size},sharpening={sharpening}]"
+                results.append({"name": label, **timeit(lambda: node.prep_image(image, False, "LANCZOS", "center", sharpening, backend), repeat)})
+
+    for batch_size in batch_sizes:
+        image = torch.rand(batch_size, 3, 224, 224)
+        results.append({"name": f"contrast_adaptive_sharpening[batch={batch_size}]", **timeit(lambda: ipadapter.contrast_adaptive_sharpening(image, 0.5), repeat)})
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,46 @@
+# loading an IPAdapter checkpoint from disk (cold) and from the in-memory model cache (warm)
+#   python benchmarks/bench_loader.py
+import json
+import os
+import sys
+import tempfile
+
+import torch
+from safetensors.torch import save_file
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.common import timeit, load_ipadapter_plus
+
+def random_checkpoint(path, ipadapter):
+    # a SD1.5 plus model: the Resampler and the K/V projections with random weights
+    from resampler import Resampler
+    image_proj = Resampler(dim=768, depth=4, dim_head=64, heads=12, num_queries=16, embedding_dim=1280, output_dim=768, ff_mult=4)
+    tensors = {f"image_proj.{key}": value.half().contiguous() for key, value in image_proj.state_dict().items()}
+    for i, channels in enumerate(ipadapter.SD_V12_CHANNELS):
+        tensors[f"ip_adapter.{i // 2 * 2 + 1}.to_{'kv'[i % 2]}_ip.weight"] = torch.randn(channels, 768).half()
+    save_file(tensors, path)
+
+def run(repeat=5):
+    ipadapter = load_ipadapter_plus()
+    results = []
+    models_dir, model_cache = ipadapter.MODELS_DIR, ipadapter.model_cache
+    with tempfile.TemporaryDirectory() as temp_dir:
+        random_checkpoint(os.path.join(temp_dir, "ip-adapter-plus_sd15.safetensors"), ipadapter)
+        # the loader node reads from MODELS_DIR through the module model cache, both point to the benchmark
+        ipadapter.MODELS_DIR = temp_dir
+        ipadapter.model_cache = ipadapter.ModelCache(1024 * 1024 * 1024)
+        loader = ipadapter.IPAdapterModelLoader()
+
+        def cold():
+            ipadapter.model_cache.clear()
+            loader.load_ipadapter_model("ip-adapter-plus_sd15.safetensors")
+
+        try:
+            results.append({"name": "load_ipadapter_model[sd15_plus,cold]", **timeit(cold, repeat)})
+            results.append({"name": "load_ipadapter_model[sd15_plus,cached]", **timeit(lambda: loader.load_ipadapter_model("ip-adapter-plus_sd15.safetensors"), repeat)})
+        finally:
+            ipadapter.MODELS_DIR, ipadapter.model_cache = models_dir, model_cache
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,83 @@
+# peak and retained memory of the first step of the attention patch at batch 8 and 1024x1024, against
+# the original patch that repeated the K/V and the mask to the full batch on every call
+#   python benchmarks/bench_memory.py [--device cuda]
+import argparse
+import json
+import os
+import sys
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.common import load_ipadapter_plus, memory_usage
+from benchmarks.bench_attention import build_patch
+
+# first cross attention layer at 1024x1024
+SHAPES = {
+    "sd15": dict(latent=128, rate=1, channels=320, heads=8, tokens=4),
+    "sdxl": dict(latent=128, rate=2, channels=640, heads=10, tokens=4),
+}
+
+def original_patch(patch, optimized_attention):
+    # CrossAttentionPatch.__call__ before the K/V cache views, with the K/V of the same StaticKV
+    def forward(q, k, v, extra_options):
+        cond_or_uncond = extra_options["cond_or_uncond"]
+        qs = q.shape[1]
+        batch_prompt = q.shape[0] // len(cond_or_uncond)
+        out = optimized_attention(q, k, v, extra_options["n_heads"])
+        _, _, lh, lw = extra_options["original_shape"]
+
+        for weight, kv_cache, mask in zip(patch.weights, patch.kv_caches, patch.masks):
+            k_cond, k_uncond, v_cond, v_uncond = (kv.repeat(batch_prompt, 1, 1) for kv in kv_cache.get(patch.number, q.dtype, q.device))
+            ip_k = torch.cat([(k_cond, k_uncond)[i] for i in cond_or_uncond], dim=0)
+            ip_v = torch.cat([(v_cond, v_uncond)[i] for i in cond_or_uncond], dim=0)
+
+            out_ip = optimized_attention(q, ip_k, ip_v, extra_options["n_heads"]) * weight
+
+            if mask is not None:
+                for rate in [1, 2, 4, 8]:
+                    mask_h = -(-lh//rate)
+                    mask_w = -(-lw//rate)
+                    if mask_h*mask_w == qs:
+                        break
+
+                mask_downsample = F.interpolate(mask.mask.unsqueeze(0), size=(mask_h, mask_w), mode="bilinear").squeeze(0)
+                mask_downsample = mask_downsample.view(1, -1, 1).repeat(out.shape[0], 1, out.shape[2])
+                out_ip = out_ip * mask_downsample
+
+            out = out + out_ip
+
+        return out
+    return forward
+
+@torch.inference_mode()
+def run(repeat=5, batch_size=8, device="cpu"):
+    ipadapter = load_ipadapter_plus()
+    results = []
+    for name, shape in SHAPES.items():
+        side = shape["latent"] // shape["rate"]
+        q = torch.randn(batch_size * 2, side * side, shape["channels"], device=device)
+        context = torch.randn(batch_size * 2, 77, shape["channels"], device=device)
+        extra_options = {
+            "cond_or_uncond": [1, 0],
+            "n_heads": shape["heads"],
+            "original_shape": [batch_size * 2, 4, shape["latent"], shape["latent"]],
+        }
+        for images in (1, 20):
+            for adapters in (1, 2):
+                for masked in (False, True):
+                    for version in ("original", "current"):
+                        # a new patch for each measure, the memory it keeps between the steps is counted
+                        patch = build_patch(ipadapter, adapters, {**shape, "tokens": shape["tokens"] * images}, masked)
+                        fn = original_patch(patch, ipadapter.optimized_attention) if version == "original" else patch
+                        peak, retained = memory_usage(lambda: fn(q, context, context, extra_options), device)
+                        label = f"attention_patch_memory[{name},batch={batch_size},images={images},adapters={adapters},mask={str(masked).lower()},{version}]"
+                        results.append({"name": label, "peak_mb": peak, "retained_mb": retained})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+    print(json.dumps(run(device=args.device), indent=2))
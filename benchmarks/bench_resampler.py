@@ -0,0 +1,29 @@
+# Resampler.forward with the plus models shapes
+#   python benchmarks/bench_resampler.py
+import json
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from resampler import Resampler
+from benchmarks.common import timeit
+
+CONFIGS = {
+    "sd15_plus": dict(dim=768, heads=12, embedding_dim=1280, output_dim=768),
+    "sdxl_plus": dict(dim=1280, heads=20, embedding_dim=1280, output_dim=2048),
+}
+
+@torch.inference_mode()
+def run(repeat=5, batch_sizes=(1, 16, 64), device="cpu"):
+    results = []
+    for name, config in CONFIGS.items():
+        model = Resampler(depth=4, dim_head=64, num_queries=16, ff_mult=4, **config).to(device).eval()
+        for batch_size in batch_sizes:
+            x = torch.randn(batch_size, 257, config["embedding_dim"], device=device)
+            results.append({"name": f"resampler_forward[{name},batch={batch_size}]", **timeit(lambda: model(x), repeat)})
+    return results
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
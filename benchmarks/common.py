@@ -0,0 +1,64 @@
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+def timeit(fn, repeat=5, warmup=1):
+    # median and min wall time of fn in ms
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {"ms": statistics.median(times), "min_ms": min(times), "repeat": repeat}
+
+def load_ipadapter_plus():
+    # IPAdapterPlus.py imports comfy.* and folder_paths at module level, the local stubs stand in
+    # for the ComfyUI runtime. The repo is imported as a package because of its relative imports
+    if "ipadapter_plus" in sys.modules:
+        return sys.modules["ipadapter_plus"].IPAdapterPlus
+
+    sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "stubs"))
+    spec = importlib.util.spec_from_file_location("ipadapter_plus", os.path.join(REPO_DIR, "__init__.py"), submodule_search_locations=[REPO_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ipadapter_plus"] = module
+    spec.loader.exec_module(module)
+    return module.IPAdapterPlus
+
+def memory_usage(fn, device="cpu"):
+    # (peak, retained) memory in MB allocated by fn on top of what was allocated before the call. The
+    # retained memory is what is still allocated after fn returns, its result excluded. On CPU the
+    # allocations are read from the memory events of the torch profiler
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        start = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - start) / 2**20, (torch.cuda.memory_allocated(device) - start) / 2**20
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "trace.json")
+        prof.export_chrome_trace(path)
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+
+    allocated = peak = 0
+    for event in sorted((e for e in events if e.get("name") == "[memory]"), key=lambda e: e["ts"]):
+        if event["args"].get("Device Type", 0) == 0:
+            allocated += event["args"]["Bytes"]
+            peak = max(peak, allocated)
+    return peak / 2**20, allocated / 2**20
@@ -0,0 +1,67 @@
+# runs all the benchmarks on CPU and writes the results as JSON, to be compared across commits
+#   python benchmarks/run.py --output results.json [--filter attention] [--repeat 5]
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks import bench_attention, bench_image, bench_loader, bench_memory, bench_resampler
+from benchmarks.common import REPO_DIR
+
+SUITES = {
+    "attention": bench_attention,
+    "resampler": bench_resampler,
+    "image": bench_image,
+    "loader": bench_loader,
+    "memory": bench_memory,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="IPAdapter benchmarks")
+    parser.add_argument("--output", help="JSON file for the results, printed if not set")
+    parser.add_argument("--filter", default="", help="only run the suites whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 = torch default")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    results = []
+    for name, suite in SUITES.items():
+        if args.filter in name:
+            print(f"running {name}...", file=sys.stderr)
+            results += suite.run(repeat=args.repeat)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "threads": torch.get_num_threads(),
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
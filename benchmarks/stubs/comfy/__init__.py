@@ -0,0 +1,2 @@
+# minimal stand-in of the parts of the ComfyUI runtime used by IPAdapterPlus.py, enough to run
+# the nodes on CPU outside of ComfyUI. Only used by the benchmarks
@@ -0,0 +1,8 @@
+import torch
+import torch.nn.functional as F
+
+def clip_preprocess(image, size=224):
+    mean = torch.tensor([0.48145466, 0.4578275, 0.40821073], device=image.device).view(1, 3, 1, 1)
+    std = torch.tensor([0.26862954, 0.26130258, 0.27577711], device=image.device).view(1, 3, 1, 1)
+    image = F.interpolate(image.movedim(-1, 1), size=(size, size), mode="bicubic", antialias=True)
+    return (image - mean) / std
@@ -0,0 +1,25 @@
+import torch
+
+# the patchers loaded on their load device, like comfy's current_loaded_models
+current_loaded_models = []
+
+def get_torch_device():
+    return torch.device("cpu")
+
+def unet_offload_device():
+    return torch.device("cpu")
+
+def get_autocast_device(dev):
+    return dev.type if hasattr(dev, "type") else "cpu"
+
+def load_model_gpu(model):
+    if model in current_loaded_models:
+        current_loaded_models.remove(model)
+    else:
+        model.patch_model(model.load_device)
+    current_loaded_models.insert(0, model)
+
+def unload_all_models():
+    while current_loaded_models:
+        model = current_loaded_models.pop()
+        model.unpatch_model(model.offload_device)
@@ -0,0 +1,22 @@
+class ModelPatcher:
+    def __init__(self, model, load_device, offload_device):
+        self.model = model
+        self.load_device = load_device
+        self.offload_device = offload_device
+
+    def patch_model(self, device_to=None):
+        if device_to is not None:
+            self.move(device_to)
+        return self.model
+
+    def unpatch_model(self, device_to=None):
+        if device_to is not None:
+            self.move(device_to)
+
+    def move(self, device):
+        # the tests use the meta device as a second device on CPU only machines, its tensors have
+        # no data to copy back
+        if any(t.is_meta for t in list(self.model.parameters()) + list(self.model.buffers())):
+            self.model.to_empty(device=device)
+        else:
+            self.model.to(device)
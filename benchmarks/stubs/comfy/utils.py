@@ -0,0 +1,11 @@
+import torch
+import torch.nn.functional as F
+from safetensors.torch import load_file
+
+def load_torch_file(ckpt, safe_load=False, device=None):
+    if ckpt.lower().endswith(".safetensors"):
+        return load_file(ckpt, device=str(device or "cpu"))
+    return torch.load(ckpt, map_location=device or "cpu", weights_only=safe_load)
+
+def common_upscale(samples, width, height, upscale_method, crop):
+    return F.interpolate(samples, size=(height, width), mode=upscale_method)
@@ -0,0 +1,16 @@
+import os
+import tempfile
+
+base_path = os.path.join(tempfile.gettempdir(), "ipadapter_benchmarks")
+
+def get_temp_directory():
+    return os.path.join(base_path, "temp")
+
+def get_input_directory():
+    return os.path.join(base_path, "input")
+
+def get_output_directory():
+    return os.path.join(base_path, "output")
+
+def get_annotated_filepath(name):
+    return os.path.join(get_input_directory(), name)
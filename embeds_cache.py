@@ -0,0 +1,103 @@
+import hashlib
+import os
+import weakref
+from collections import OrderedDict
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+def tensor_hash(tensor):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{tuple(tensor.shape)} {tensor.dtype}".encode())
+    h.update(tensor.detach().contiguous().cpu().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+# fingerprint of each clip vision model
+model_hashes = weakref.WeakKeyDictionary()
+
+def model_hash(model):
+    # hashing all the weights would take seconds, names, shapes and the first values of each
+    # tensor are enough to tell the clip vision models apart
+    if model not in model_hashes:
+        h = hashlib.blake2b(digest_size=16)
+        for name, tensor in model.state_dict().items():
+            h.update(f"{name} {tuple(tensor.shape)} {tensor.dtype}".encode())
+            h.update(tensor.detach().flatten()[:256].contiguous().cpu().view(torch.uint8).numpy().tobytes())
+        model_hashes[model] = h.hexdigest()
+
+    return model_hashes[model]
+
+class EmbedsCache:
+    # content addressed disk cache of the clip vision embeddings. Each image of a batch is a
+    # separate safetensors file named after the hash of the image, the model and the output kind.
+    # The least recently used files are removed when the cache grows over max_bytes
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index = None
+        self.size = 0
+
+    def load_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".safetensors"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len(".safetensors")], stat.st_size))
+
+        # oldest first, the access time is kept in the file modification time
+        self.index = OrderedDict((key, size) for _, key, size in sorted(files))
+        self.size = sum(self.index.values())
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".safetensors")
+
+    def keys(self, model, image, kind, hashes=None):
+        # hashes: the tensor_hash of the images already computed by the caller, None to hash them here
+        model_key = model_hash(model)
+        hashes = hashes if hashes is not None else [None] * image.shape[0]
+        hashes = [h if h is not None else tensor_hash(img) for img, h in zip(image, hashes)]
+        return [hashlib.blake2b(f"{h} {model_key} {kind}".encode(), digest_size=16).hexdigest() for h in hashes]
+
+    def get(self, keys):
+        if self.index is None:
+            self.load_index()
+
+        embeds = []
+        for key in keys:
+            embed = None
+            if key in self.index:
+                try:
+                    # safetensors memory maps the file, only the tensor data is read
+                    with safe_open(self.filename(key), framework="pt") as f:
+                        embed = f.get_tensor("embeds")
+                    os.utime(self.filename(key))
+                    self.index.move_to_end(key)
+                except OSError:
+                    self.size -= self.index.pop(key)
+            embeds.append(embed)
+
+        return embeds
+
+    def put(self, key, embed):
+        if self.index is None:
+            self.load_index()
+
+        filename = self.filename(key)
+        tmp = filename + ".tmp"
+        save_file({"embeds": embed.detach().contiguous().cpu()}, tmp)
+        os.replace(tmp, filename)
+
+        if key in self.index:
+            self.size -= self.index.pop(key)
+        self.index[key] = os.path.getsize(filename)
+        self.size += self.index[key]
+
+        while self.size > self.max_bytes and len(self.index) > 1:
+            old_key, size = self.index.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.filename(old_key))
+            except OSError:
+                pass
@@ -0,0 +1,89 @@
+import os
+
+class FileIndex:
+    # index of the files with the given extensions found in a directory (and its sub-directories).
+    # A directory is listed again only when its modification time changes, so refreshing the index
+    # costs one stat per directory instead of walking all the files
+    def __init__(self, root, extensions, recursive=True, metadata=None):
+        self.root = root
+        self.extensions = tuple(extensions)
+        self.recursive = recursive
+        self.metadata_fn = metadata
+        self.dirs = {}
+
+    def refresh(self):
+        seen = set()
+        self.scan("", seen)
+
+        for rel in [rel for rel in self.dirs if rel not in seen]:
+            del self.dirs[rel]
+
+    def scan(self, rel, seen):
+        path = os.path.join(self.root, rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+
+        seen.add(rel)
+        entry = self.dirs.get(rel)
+
+        if entry is None or entry[0] != mtime:
+            old_files = entry[2] if entry is not None else {}
+            subdirs = []
+            files = {}
+
+            try:
+                with os.scandir(path) as it:
+                    for e in it:
+                        # symlinked directories are not followed, like os.walk
+                        if e.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                subdirs.append(e.name)
+                        elif e.name.endswith(self.extensions):
+                            try:
+                                stat = e.stat()
+                            except OSError:
+                                continue
+                            info = old_files.get(e.name)
+                            # keep the metadata of the files that didn't change
+                            if info is None or info["mtime"] != stat.st_mtime_ns or info["size"] != stat.st_size:
+                                info = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+                            files[e.name] = info
+            except OSError:
+                # unreadable directory, its content is left out of the index
+                seen.discard(rel)
+                self.dirs.pop(rel, None)
+                return
+
+            entry = (mtime, subdirs, files)
+            self.dirs[rel] = entry
+
+        for subdir in entry[1]:
+            self.scan(os.path.join(rel, subdir), seen)
+
+    def list(self, prefix=""):
+        self.refresh()
+        files = [os.path.join(rel, name) if rel else name for rel, (_, _, names) in self.dirs.items() for name in names]
+        return sorted(f for f in files if f.startswith(prefix))
+
+    def info(self, name):
+        # size, modification time and metadata of a file in the index. The metadata is read on first request
+        rel, filename = os.path.split(name)
+        info = self.dirs.get(rel, (None, None, {}))[2].get(filename)
+        if info is not None and "metadata" not in info:
+            info["metadata"] = None
+            if self.metadata_fn is not None:
+                try:
+                    info["metadata"] = self.metadata_fn(os.path.join(self.root, name))
+                except Exception:
+                    pass
+        return info
+
+file_indexes = {}
+
+def get_file_index(root, extensions, recursive=True, metadata=None):
+    key = (root, tuple(extensions), recursive)
+    if key not in file_indexes:
+        file_indexes[key] = FileIndex(root, extensions, recursive=recursive, metadata=metadata)
+    return file_indexes[key]
@@ -0,0 +1,119 @@
+import contextlib
+import json
+import time
+from collections import OrderedDict
+
+import torch
+
+# used by the attention patch when profiling is off, entering it does nothing
+NO_PROFILE = contextlib.nullcontext()
+
+def no_section(number, adapter, name):
+    return NO_PROFILE
+
+class Section:
+    # one timed region of the attention patch. With the cuda backend the time is measured by events
+    # recorded in the stream and only read when the results are needed, so nothing syncs
+    def __init__(self, profiler, number, adapter, name):
+        self.profiler = profiler
+        self.key = (number, adapter, name)
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.memory:
+            torch.cuda.reset_peak_memory_stats(profiler.device)
+            self.memory = torch.cuda.memory_allocated(profiler.device)
+        if profiler.backend == "cuda":
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            if profiler.device.type == "cuda":
+                torch.cuda.synchronize(profiler.device)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        if profiler.backend == "cuda":
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+        else:
+            if profiler.device.type == "cuda":
+                torch.cuda.synchronize(profiler.device)
+            end = time.perf_counter()
+
+        memory = None
+        if profiler.memory:
+            memory = torch.cuda.max_memory_allocated(profiler.device) - self.memory
+        profiler.events.append((self.key, self.start, end, memory))
+        return False
+
+class AttentionProfiler:
+    # per layer (the patch number) and per adapter timers of the IPAdapter attention patch.
+    # backend is "perf_counter" (syncs the device around each section) or "cuda" (cuda events).
+    # With memory=True the peak cuda memory allocated by each section is recorded too
+    def __init__(self, backend="perf_counter", memory=False, device=None):
+        self.device = torch.device(device) if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.backend = backend if self.device.type == "cuda" else "perf_counter"
+        self.memory = memory and self.device.type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        if self.backend == "cuda":
+            self.origin = torch.cuda.Event(enable_timing=True)
+            self.origin.record()
+        else:
+            self.origin = time.perf_counter()
+
+    def section(self, number, adapter, name):
+        return Section(self, number, adapter, name)
+
+    def timings(self):
+        # (key, start ms, duration ms, memory) of every section, relative to the last reset
+        if self.backend == "cuda":
+            torch.cuda.synchronize(self.device)
+            return [(key, self.origin.elapsed_time(start), start.elapsed_time(end), memory) for key, start, end, memory in self.events]
+        return [(key, (start - self.origin) * 1000, (end - start) * 1000, memory) for key, start, end, memory in self.events]
+
+    def summary(self):
+        # {(number, adapter, name): {"calls", "total_ms", "mean_ms", "max_ms", "peak_memory"}} sorted by layer
+        summary = {}
+        for key, _, duration, memory in self.timings():
+            stats = summary.setdefault(key, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "peak_memory": None})
+            stats["calls"] += 1
+            stats["total_ms"] += duration
+            stats["max_ms"] = max(stats["max_ms"], duration)
+            if memory is not None:
+                stats["peak_memory"] = max(stats["peak_memory"] or 0, memory)
+
+        for stats in summary.values():
+            stats["mean_ms"] = stats["total_ms"] / stats["calls"]
+
+        return OrderedDict(sorted(summary.items(), key=lambda item: (item[0][0], -1 if item[0][1] is None else item[0][1], item[0][2])))
+
+    def format_summary(self):
+        lines = [f"{'layer':>5} {'adapter':>7} {'section':<16} {'calls':>6} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'peak MB':>8}"]
+        totals = {}
+        for (number, adapter, name), stats in self.summary().items():
+            peak = f"{stats['peak_memory'] / 2**20:.1f}" if stats["peak_memory"] is not None else "-"
+            adapter = "-" if adapter is None else adapter
+            lines.append(f"{number:>5} {adapter:>7} {name:<16} {stats['calls']:>6} {stats['total_ms']:>10.2f} {stats['mean_ms']:>9.3f} {stats['max_ms']:>9.3f} {peak:>8}")
+            totals[name] = totals.get(name, 0.0) + stats["total_ms"]
+
+        lines.append("total: " + ", ".join(f"{name} {total:.2f}ms" for name, total in totals.items()))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        # chrome://tracing (and perfetto) format, one row per layer
+        events = []
+        for (number, adapter, name), start, duration, memory in self.timings():
+            args = {"layer": number, "adapter": adapter}
+            if memory is not None:
+                args["peak_memory"] = memory
+            events.append({"name": name, "cat": "ipadapter", "ph": "X", "pid": 0, "tid": number, "ts": start * 1000, "dur": duration * 1000, "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -3,6 +3,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 # FFN
@@ -21,10 +22,8 @@ def reshape_tensor(x, heads):
     #(bs, length, width) --> (bs, length, n_heads, dim_per_head)
     x = x.view(bs, length, heads, -1)
     # (bs, length, n_heads, dim_per_head) --> (bs, n_heads, length, dim_per_head)
-    x = x.transpose(1, 2)
-    # (bs, n_heads, length, dim_per_head) --> (bs*n_heads, length, dim_per_head)
-    x = x.reshape(bs, heads, length, -1)
-    return x
+    # a strided view, the attention doesn't need a contiguous copy
+    return x.transpose(1, 2)
 
 
 class PerceiverAttention(nn.Module):
@@ -64,13 +63,16 @@ class PerceiverAttention(nn.Module):
         k = reshape_tensor(k, self.heads)
         v = reshape_tensor(v, self.heads)
 
-        # attention
-        scale = 1 / math.sqrt(math.sqrt(self.dim_head))
-        weight = (q * scale) @ (k * scale).transpose(-2, -1) # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        out = weight @ v
+        # attention, the fused kernels accumulate the softmax in float32 like the f16 safe version below
+        if hasattr(F, "scaled_dot_product_attention"):
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            scale = 1 / math.sqrt(math.sqrt(self.dim_head))
+            weight = (q * scale) @ (k * scale).transpose(-2, -1) # More stable with f16 than dividing afterwards
+            weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+            out = weight @ v
         
-        out = out.permute(0, 2, 1, 3).reshape(b, l, -1)
+        out = out.transpose(1, 2).reshape(b, l, -1)
 
         return self.to_out(out)
 
@@ -109,7 +111,7 @@ class Resampler(nn.Module):
 
     def forward(self, x):
         
-        latents = self.latents.repeat(x.size(0), 1, 1)
+        latents = self.latents.expand(x.size(0), -1, -1)
         
         x = self.proj_in(x)
         
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from benchmarks.common import load_ipadapter_plus
+
+# IPAdapterPlus.py imported with the stand-in ComfyUI runtime of the benchmarks, this also puts
+# the stubs on sys.path for the tests importing comfy.*
+IPAdapterPlus = load_ipadapter_plus()
+
+@pytest.fixture(scope="session")
+def ipadapter():
+    return IPAdapterPlus
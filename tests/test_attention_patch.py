@@ -0,0 +1,155 @@
+import copy
+
+import pytest
+import torch
+
+from comfy.ldm.modules.attention import optimized_attention
+
+class ModelSampling:
+    def percent_to_sigma(self, percent):
+        return 14.6 * (1 - percent) + 0.03 * percent
+
+class Model:
+    # the parts of comfy's ModelPatcher used by the apply nodes
+    def __init__(self, dtype):
+        self.model = type("BaseModel", (), {})()
+        self.model.diffusion_model = type("UNet", (), {"dtype": dtype})()
+        self.model.model_sampling = ModelSampling()
+        self.model_options = {"transformer_options": {}}
+
+    def clone(self):
+        model = copy.copy(self)
+        model.model_options = copy.deepcopy(self.model_options)
+        return model
+
+def sd15_checkpoint(channels):
+    torch.manual_seed(0)
+    return {
+        "image_proj": {
+            "proj.weight": torch.randn(4 * 768, 1024) * 0.02,
+            "proj.bias": torch.zeros(4 * 768),
+            "norm.weight": torch.ones(768),
+            "norm.bias": torch.zeros(768),
+        },
+        "ip_adapter": {f"{i // 2 * 2 + 1}.to_{'kv'[i % 2]}_ip.weight": torch.randn(channel, 768) * 0.03 for i, channel in enumerate(channels)},
+    }
+
+def apply(ipadapter, dtype, mask=None, weight_type="original", **kwargs):
+    checkpoint = sd15_checkpoint(ipadapter.SD_V12_CHANNELS)
+    embeds = torch.stack((torch.randn(1, 1024, generator=torch.Generator().manual_seed(1)), torch.zeros(1, 1024)))
+    model = ipadapter.IPAdapterApplyEncoded().apply_ipadapter(checkpoint, Model(dtype), 0.8, weight_type=weight_type, embeds=embeds, attn_mask=mask, **kwargs)[0]
+    return model.model_options["transformer_options"]["patches_replace"]["attn2"]
+
+def inputs():
+    generator = torch.Generator().manual_seed(2)
+    q = torch.randn(2, 64 * 64, 320, generator=generator)
+    context = torch.randn(2, 77, 320, generator=generator)
+    extra_options = {"cond_or_uncond": [1, 0], "n_heads": 8, "original_shape": [2, 4, 64, 64], "sigmas": torch.tensor([5.0])}
+    return q, context, extra_options
+
+@pytest.mark.parametrize("dtype,atol", [(torch.float32, 1e-5), (torch.bfloat16, 5e-2)])
+@pytest.mark.parametrize("masked", [False, True])
+def test_patch_matches_attention_plus_ip_attention(ipadapter, dtype, atol, masked):
+    mask = None
+    if masked:
+        mask = torch.zeros(1, 512, 512)
+        mask[..., :256] = 1
+
+    patch = apply(ipadapter, dtype, mask)[("input", 1)]
+    q, context, extra_options = inputs()
+    out = patch(q, context, context, extra_options)
+
+    k_cond, k_uncond, v_cond, v_uncond = patch.kv_caches[0].get(0, dtype)
+    q, context = q.to(dtype), context.to(dtype)
+    expected = optimized_attention(q, context, context, 8)
+    ip = optimized_attention(q, torch.cat((k_uncond, k_cond)), torch.cat((v_uncond, v_cond)), 8)
+    if masked:
+        ip = ip * (torch.arange(64 * 64) % 64 < 32).view(1, -1, 1).to(dtype)
+    expected = expected + 0.8 * ip
+
+    assert out.dtype == torch.float32
+    assert torch.allclose(out, expected.float(), atol=atol)
+
+def test_patch_skips_steps_out_of_range(ipadapter):
+    patches = apply(ipadapter, torch.float32, start_at=0.5, blocks="input")
+    assert {key[0] for key in patches} == {"input"}
+
+    patch = patches[("input", 1)]
+    q, context, extra_options = inputs()
+    out = patch(q, context, context, {**extra_options, "sigmas": torch.tensor([10.0])})
+
+    assert torch.allclose(out, optimized_attention(q, context, context, 8))
+    assert (patch.calls, patch.skipped) == (0, 1)
+
+def test_chunked_patch_is_exact(ipadapter):
+    mask = torch.zeros(1, 512, 512)
+    mask[:, :128] = 1
+    q, context, extra_options = inputs()
+
+    out = apply(ipadapter, torch.float32, mask)[("input", 1)](q, context, context, extra_options)
+    chunked = apply(ipadapter, torch.float32, mask, chunk_size=1000)[("input", 1)](q, context, context, extra_options)
+
+    assert torch.equal(out, chunked)
+
+def test_kv_cache_dtype(ipadapter):
+    kv_cache = apply(ipadapter, torch.float32, kv_cache_dtype="bf16")[("input", 1)].kv_caches[0]
+    assert all(kv.dtype == torch.bfloat16 for kv in kv_cache.kvs[0])
+
+    kv_cache = apply(ipadapter, torch.float32)[("input", 1)].kv_caches[0]
+    assert all(kv.dtype == torch.float32 for kv in kv_cache.kvs[0])
+
+@pytest.mark.parametrize("weight_type", ["original", "linear"])
+def test_patch_keeps_the_kv_in_the_cache_dtype(ipadapter, weight_type):
+    patch = apply(ipadapter, torch.float32, kv_cache_dtype="bf16", weight_type=weight_type)[("input", 1)]
+    q, context, extra_options = inputs()
+    out = patch(q, context, context, extra_options)
+    assert out.dtype == torch.float32
+
+    # only the [1, tokens, C] K/V are kept between the steps, not the batch layout
+    _, ks, vs = patch.kv_weighted[0]
+    assert all(kv.dtype == torch.bfloat16 and kv.shape[0] == 1 for kv in ks + vs)
+    if weight_type == "original":
+        k_cond, k_uncond, v_cond, v_uncond = patch.kv_caches[0].kvs[0]
+        assert ks[0].data_ptr() == k_cond.data_ptr() and vs[1].data_ptr() == v_uncond.data_ptr()
+
+def test_clone_resets_the_counters(ipadapter):
+    patch = apply(ipadapter, torch.float32)[("input", 1)]
+    q, context, extra_options = inputs()
+    patch(q, context, context, extra_options)
+    assert patch.calls == 1
+
+    clone = copy.deepcopy(patch)
+    assert (clone.calls, clone.skipped) == (0, 0)
+    assert clone.kv_caches[0] is patch.kv_caches[0]
+
+def test_aggregate_tokens(ipadapter):
+    cond, uncond = torch.randn(5, 16, 768), torch.randn(5, 16, 768)
+
+    mean = ipadapter.aggregate_tokens(cond, uncond, "mean", 16)
+    assert torch.allclose(mean[0], cond.mean(0, keepdim=True)) and torch.allclose(mean[1], uncond.mean(0, keepdim=True))
+
+    for mode in ("k-means", "top-k"):
+        pooled = ipadapter.aggregate_tokens(cond, uncond, mode, 16)
+        assert pooled[0].shape[0] == 1 and pooled[0].shape[1] <= 16 and pooled[0].shape == pooled[1].shape
+
+def test_sigma_is_read_once_per_step(ipadapter, capsys):
+    patches = apply(ipadapter, torch.float32, start_at=0.5)
+    q, context, extra_options = inputs()
+    sigmas = torch.tensor([10.0])
+    reads = [0]
+    class Sigmas:
+        def max(self):
+            reads[0] += 1
+            return sigmas.max()
+    step = {**extra_options, "sigmas": Sigmas()}
+    for key in [("input", 1), ("input", 2), ("output", 3)]:
+        patches[key](q, context, context, step)
+    assert reads[0] == 1
+
+    # without sigmas the range can't be checked, the patch runs and warns once
+    extra_options.pop("sigmas")
+    ipadapter.sigmas_warning[0] = False
+    for key in [("input", 1), ("input", 2)]:
+        patches[key](q, context, context, extra_options)
+    assert patches[("input", 2)].calls == 1
+    assert capsys.readouterr().out.count("start_at/end_at") == 1
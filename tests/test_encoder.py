@@ -0,0 +1,68 @@
+import sys
+import types
+
+import pytest
+import torch
+
+from comfy.model_patcher import ModelPatcher
+
+class VisionModel(torch.nn.Module):
+    def forward(self, pixel_values, output_hidden_states=True):
+        return {"hidden_states": [torch.zeros(pixel_values.shape[0], 3, 1024)] * 2}
+
+class ClipVision:
+    # encodes an image into its first pixels, enough to tell where each embed comes from
+    load_device = torch.device("cpu")
+    dtype = torch.float32
+
+    def __init__(self):
+        self.model = VisionModel()
+        self.patcher = ModelPatcher(self.model, self.load_device, self.load_device)
+        self.encoded = 0
+
+    def encode_image(self, image):
+        self.encoded += image.shape[0]
+        flat = image.reshape(image.shape[0], -1)[:, :1024].float()
+        return types.SimpleNamespace(image_embeds=flat, penultimate_hidden_states=flat.unsqueeze(1).repeat(1, 3, 1))
+
+@pytest.fixture
+def images():
+    a, b, c = torch.rand(3, 64, 64, 3, generator=torch.Generator().manual_seed(0)).unbind()
+    return torch.stack([a, b, a, a, c, b])
+
+@pytest.fixture
+def hash_count(ipadapter, monkeypatch):
+    # number of images hashed, by the dedup and by the embeds cache
+    embeds_cache = sys.modules[ipadapter.EmbedsCache.__module__]
+    count = [0]
+    def tensor_hash(tensor, tensor_hash=embeds_cache.tensor_hash):
+        count[0] += 1
+        return tensor_hash(tensor)
+    monkeypatch.setattr(ipadapter, "tensor_hash", tensor_hash)
+    monkeypatch.setattr(embeds_cache, "tensor_hash", tensor_hash)
+    return count
+
+@pytest.mark.parametrize("batch_size", [0, 1, 2])
+def test_encoder_dedup(ipadapter, images, hash_count, batch_size):
+    clip_vision = ClipVision()
+    out = ipadapter.IPAdapterEncoder().preprocess(clip_vision, images, True, 0.0, 1.0, batch_size=batch_size)[0]
+    assert (clip_vision.encoded, hash_count[0]) == (3, 6)
+
+    clip_vision = ClipVision()
+    expected = ipadapter.IPAdapterEncoder().preprocess(clip_vision, images, True, 0.0, 1.0, batch_size=batch_size, dedup=False)[0]
+    assert (clip_vision.encoded, hash_count[0]) == (6, 6)
+
+    assert torch.equal(out, expected)
+
+def test_embeds_cache_reuses_the_hashes(ipadapter, images, hash_count, monkeypatch, tmp_path):
+    monkeypatch.setattr(ipadapter, "embeds_cache", ipadapter.EmbedsCache(str(tmp_path), 2**30))
+
+    clip_vision = ClipVision()
+    embeds = ipadapter.encode_clip_embeds(clip_vision, images, False, 0.0)
+    assert (clip_vision.encoded, hash_count[0]) == (3, 6)
+
+    clip_vision.encoded = 0
+    cached = ipadapter.IPAdapterEncoder().preprocess(clip_vision, images, False, 0.0, 1.0, batch_size=2)[0]
+    assert (clip_vision.encoded, hash_count[0]) == (0, 12)
+
+    assert torch.equal(cached[0], embeds[0]) and torch.equal(cached[1], embeds[1])
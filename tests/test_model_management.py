@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+import comfy.model_management
+
+from test_attention_patch import Model
+
+@pytest.fixture
+def checkpoint(ipadapter):
+    return {
+        "image_proj": {"proj.weight": torch.randn(4 * 768, 1024), "proj.bias": torch.zeros(4 * 768), "norm.weight": torch.ones(768), "norm.bias": torch.zeros(768)},
+        "ip_adapter": {f"{i // 2 * 2 + 1}.to_{'kv'[i % 2]}_ip.weight": torch.randn(channel, 768) for i, channel in enumerate(ipadapter.SD_V12_CHANNELS)},
+    }
+
+def devices(module):
+    return {t.device.type for t in list(module.parameters()) + list(module.buffers())}
+
+def test_adapter_is_built_on_the_offload_device(ipadapter, checkpoint, monkeypatch):
+    # the meta device stands in for the offload device, nothing can end up there by accident
+    monkeypatch.setattr(comfy.model_management, "unet_offload_device", lambda: torch.device("meta"))
+    monkeypatch.setattr(ipadapter, "adapter_cache", type(ipadapter.adapter_cache)())
+
+    patcher = ipadapter.get_ipadapter(checkpoint, torch.float16, cross_attention_dim=768, output_cross_attention_dim=768, clip_embeddings_dim=1024)
+
+    assert patcher.offload_device == torch.device("meta")
+    assert patcher.load_device == comfy.model_management.get_torch_device()
+    assert devices(patcher.model) == {"meta"}
+    assert all(t.dtype == torch.float16 for t in patcher.model.parameters())
+
+def test_adapter_is_offloaded_after_the_apply(ipadapter, checkpoint, monkeypatch):
+    # the meta device stands in for the GPU, the adapter must go back to the CPU when comfy unloads it
+    monkeypatch.setattr(comfy.model_management, "get_torch_device", lambda: torch.device("meta"))
+    monkeypatch.setattr(comfy.model_management, "current_loaded_models", [])
+    monkeypatch.setattr(ipadapter, "adapter_cache", type(ipadapter.adapter_cache)())
+
+    embeds = torch.stack((torch.randn(1, 1024), torch.zeros(1, 1024)))
+    ipadapter.IPAdapterApplyEncoded().apply_ipadapter(checkpoint, Model(torch.float32), 0.8, weight_type="original", embeds=embeds)
+
+    # the apply loads the adapter through comfy's model management
+    (patcher, ) = comfy.model_management.current_loaded_models
+    assert patcher.load_device.type == "meta" and devices(patcher.model) == {"meta"}
+
+    comfy.model_management.unload_all_models()
+    assert patcher.offload_device.type == "cpu" and devices(patcher.model) == {"cpu"}
+
+    # the next apply finds the same adapter in the cache and loads it again
+    ipadapter.IPAdapterApplyEncoded().apply_ipadapter(checkpoint, Model(torch.float32), 0.5, weight_type="original", embeds=embeds)
+    assert comfy.model_management.current_loaded_models == [patcher] and devices(patcher.model) == {"meta"}
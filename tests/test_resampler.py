@@ -0,0 +1,41 @@
+import math
+
+import pytest
+import torch
+
+from ipadapter_plus.resampler import Resampler, PerceiverAttention
+
+def reference_attention(attn, x, latents):
+    # the original attention math, f16 safe scaling and float32 softmax
+    x = attn.norm1(x)
+    latents = attn.norm2(latents)
+    b, l, _ = latents.shape
+
+    q = attn.to_q(latents)
+    k, v = attn.to_kv(torch.cat((x, latents), dim=-2)).chunk(2, dim=-1)
+    q, k, v = (t.view(b, t.shape[1], attn.heads, -1).transpose(1, 2) for t in (q, k, v))
+
+    scale = 1 / math.sqrt(math.sqrt(attn.dim_head))
+    weight = (q * scale) @ (k * scale).transpose(-2, -1)
+    weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+    out = (weight @ v).permute(0, 2, 1, 3).reshape(b, l, -1)
+    return attn.to_out(out)
+
+@pytest.mark.parametrize("dtype,atol", [(torch.float32, 1e-5), (torch.float16, 1e-2)])
+def test_perceiver_attention_matches_reference(dtype, atol):
+    torch.manual_seed(0)
+    attn = PerceiverAttention(dim=768, dim_head=64, heads=12).to(dtype)
+    x = torch.randn(2, 257, 768, dtype=dtype)
+    latents = torch.randn(2, 16, 768, dtype=dtype)
+
+    with torch.inference_mode():
+        out = attn(x, latents)
+        expected = reference_attention(attn, x, latents)
+
+    assert out.dtype == dtype
+    assert torch.allclose(out.float(), expected.float(), atol=atol)
+
+def test_resampler_output_shape():
+    resampler = Resampler(dim=768, depth=2, dim_head=64, heads=12, num_queries=16, embedding_dim=1280, output_dim=768)
+    with torch.inference_mode():
+        assert resampler(torch.randn(3, 257, 1280)).shape == (3, 16, 768)
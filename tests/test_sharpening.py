@@ -0,0 +1,32 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+def reference_sharpening(image, amount):
+    # the original implementation, stacking the neighbours
+    img = F.pad(image, pad=(1, 1, 1, 1))
+    a, b, c = img[..., :-2, :-2], img[..., :-2, 1:-1], img[..., :-2, 2:]
+    d, e, f = img[..., 1:-1, :-2], img[..., 1:-1, 1:-1], img[..., 1:-1, 2:]
+    g, h, i = img[..., 2:, :-2], img[..., 2:, 1:-1], img[..., 2:, 2:]
+
+    mn = torch.stack((b, d, e, f, h)).min(axis=0)[0].clamp(min=0) + torch.stack((a, c, g, i)).min(axis=0)[0].clamp(min=0)
+    mx = torch.stack((b, d, e, f, h)).max(axis=0)[0].clamp(max=1) + torch.stack((a, c, g, i)).max(axis=0)[0].clamp(max=1)
+
+    amp = torch.sqrt(torch.reciprocal(mx) * torch.minimum(mn, (2 - mx)))
+    w = - amp * (amount * (1/5 - 1/8) + 1/8)
+    div = torch.reciprocal(1 + 4*w)
+
+    output = ((b + d + f + h)*w + e) * div
+    return torch.nan_to_num(output.clamp(0, 1))
+
+@pytest.mark.parametrize("amount", [0.0, 0.3, 1.0])
+@pytest.mark.parametrize("chunk_size", [0, 1, 3])
+def test_sharpening_is_bitwise_equal(ipadapter, amount, chunk_size):
+    image = torch.rand(5, 3, 37, 41, generator=torch.Generator().manual_seed(0))
+    # flat black and white areas go through the nan paths
+    image[0] = 0
+    image[1, :, :10] = 1
+
+    output = ipadapter.contrast_adaptive_sharpening(image, amount, chunk_size)
+
+    assert torch.equal(output, reference_sharpening(image, amount))